@@ -15,6 +15,7 @@ const Module = require("./Module.js");
 // OSX only (might break elsewhere). Used for shell commands via 
 // moduleInput handling. 
 const { exec } = require('child_process');
+const crypto = require('crypto');
 
 /*
   Enums to keep constant with client logic. 
@@ -666,13 +667,27 @@ app.post('/pianoPlayMidi', (req, res) => {
     var song_name = req.body.song_name;
     var midi_contents = req.body.midi_contents;
     if(song_name != null && midi_contents != null){
-
+      // The piano player caches songs by the sha256 of their midi
+      // bytes. Try the hash first, and only send the full song if
+      // the player doesn't have it (404). 
+      var song_hash = crypto.createHash('sha256').update(Buffer.from(midi_contents, 'base64')).digest('hex');
+      const hashRequestOptions = {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ "song_name": song_name, "song_hash" : song_hash })
+      };
       const requestOptions = {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ "song_name": song_name, "midi_contents" : midi_contents })
       };
-      fetch(`http://localhost:${pianoPort}/startSong`, requestOptions);
+      fetch(`http://localhost:${pianoPort}/startSong`, hashRequestOptions).then(apiResponse => {
+        if(apiResponse.status == 404){
+          fetch(`http://localhost:${pianoPort}/startSong`, requestOptions);
+        }
+      }).catch(err => {
+        console.log("[WARNING] /pianoPlayMidi failed to reach the piano player: " + err);
+      });
       
       return res.status(200).send();
     }
@@ -709,6 +724,33 @@ app.get('/pianoStatus', async (req, res) => {
   return res.status(400).send();
 });
 
+// Pass the piano player's state changes (Server-Sent Events)
+// straight through, so clients don't have to poll /pianoStatus.
+app.get('/pianoEvents', async (req, res) => {
+  console.log("[DEBUG] /pianoEvents GET request received.");
+  if(pianoPort== null){
+    console.log("[WARNING] /pianoEvents pianoPort is null!");
+    return res.status(400).send();
+  }
+  let query = req.query.rate != null ? `?rate=${encodeURIComponent(req.query.rate)}` : "";
+  let headers = {};
+  if(req.get("Last-Event-ID") != null){
+    headers["Last-Event-ID"] = req.get("Last-Event-ID");
+  }
+  try{
+    let apiResponse = await fetch(`http://localhost:${pianoPort}/events${query}`, {headers: headers});
+    res.status(apiResponse.status);
+    res.set({"Content-Type": "text/event-stream", "Cache-Control": "no-cache"});
+    res.flushHeaders();
+    apiResponse.body.pipe(res);
+    req.on("close", () => apiResponse.body.destroy());
+  }
+  catch(err){
+    console.log("[WARNING] /pianoEvents unable to reach the piano player: " + err);
+    return res.status(400).send();
+  }
+});
+
 // TODO: Abstract this so that we could potentially have 
 // multiple satellites. 
 app.get('/toggleHotwordNoneSatellite', (req, res) => {
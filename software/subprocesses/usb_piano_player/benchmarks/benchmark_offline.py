@@ -0,0 +1,162 @@
+#
+# benchmark_offline.py
+#
+# Plays songs through UsbPianoPlayer offline, against a VirtualClock
+# (see playback_clock.py) and one or more RecordingPorts, so that a
+# song takes as long as it takes to send rather than as long as it
+# lasts. Every song is played three times, and has to arrive on every
+# port the same way:
+#
+#   full   start to finish; every event must be sent in order, at
+#          exactly its deadline
+#   stop   stopped halfway through; everything before that point and
+#          nothing after it must be sent
+#   seek   sought back to a quarter of the way through from halfway;
+#          the channel state there is restored, then the song carries
+#          on from that point
+#
+# Reports any event that went out of order or off its deadline
+# (exits 1 if there are any), and how many times faster than real
+# time the songs were played. Plays the synthetic workloads (see
+# synthetic_midi.py) unless given a directory of .mid files, i.e.
+# piano_songs.
+#
+# Usage: python3 benchmark_offline.py [--workloads long_duration,dense_chords]
+#          [--songs_location ../piano_songs] [--ports 2]
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mido import MidiFile
+from benchmark_ports import RecordingPort
+from midi_timeline import compile_midi_file, reset_messages
+from playback_clock import VirtualClock
+from usb_piano_player import UsbPianoPlayer
+import synthetic_midi
+
+# Deadlines are compared to within this many seconds.
+_deadline_tolerance = 1e-9
+
+# Real seconds to wait for playback to reach a point in the song
+# before giving up on it.
+_wait_timeout = 60
+
+# The (time, message bytes) the port should receive for events
+# [start, end) of timeline when the song starts at start_time.
+def expected_events(timeline, start_time, start = 0, end = None):
+  end = len(timeline) if end is None else end
+  return [(start_time + timeline.deadlines[i], bytes(timeline.event_bytes(i))) for i in range(start, end)]
+
+# Describe the first difference, on each port, between what was sent
+# and what was expected, if there is one.
+def compare(label, ports, expected):
+  problems = []
+  for port in ports:
+    sent = [(send_time, bytes(msg.bytes())) for send_time, msg in zip(port.send_times, port.messages)]
+    for i, (sent_event, expected_event) in enumerate(zip(sent, expected)):
+      if sent_event[1] != expected_event[1] or abs(sent_event[0] - expected_event[0]) > _deadline_tolerance:
+        problems.append("%s: event %d on %s was %s at %.9f, expected %s at %.9f" % (label, i, port.name,
+          sent_event[1].hex(), sent_event[0], expected_event[1].hex(), expected_event[0]))
+        break
+    else:
+      if len(sent) != len(expected):
+        problems.append("%s: %d events were sent to %s, expected %d" % (label, len(sent), port.name, len(expected)))
+  return problems
+
+def reset_ports(ports):
+  for port in ports:
+    port.reset()
+
+def check_full(player, clock, ports, timeline):
+  reset_ports(ports)
+  start_time = clock.now()
+  player.play_midi(timeline = timeline)
+  return compare("full", ports, expected_events(timeline, start_time))
+
+# Hold the clock between the last group of the first half of the song
+# and the first group of the second, and start the song. Returns when
+# the song started, when it is held and the first group held back.
+def play_until_halfway(player, clock, timeline):
+  group_starts = timeline.group_starts()
+  g = (len(group_starts) - 1) // 2
+  start_time = clock.now()
+  held_at = start_time + (timeline.deadlines[group_starts[g-1]] + timeline.deadlines[group_starts[g]]) / 2
+  clock.hold_at(held_at)
+  player.replace_song(timeline = timeline)
+  if not clock.wait_for(held_at, _wait_timeout):
+    raise RuntimeError("Playback never reached " + str(held_at) + ".")
+  return start_time, held_at, g
+
+def check_stop(player, clock, ports, timeline):
+  reset_ports(ports)
+  start_time, _, g = play_until_halfway(player, clock, timeline)
+  player.stop_playing()
+  clock.release()
+  return compare("stop", ports, expected_events(timeline, start_time, 0, timeline.group_starts()[g]))
+
+def check_seek(player, clock, ports, timeline):
+  reset_ports(ports)
+  start_time, held_at, g = play_until_halfway(player, clock, timeline)
+  group_starts = timeline.group_starts()
+  first = group_starts[g // 2]
+  position = timeline.deadlines[first]
+  player.seek(position)
+  clock.release()
+  player.idle_event.wait(_wait_timeout)
+
+  restore = reset_messages() + timeline.state_at(first)
+  expected = expected_events(timeline, start_time, 0, group_starts[g])
+  expected += [(held_at, bytes(message_bytes)) for message_bytes in restore]
+  expected += expected_events(timeline, held_at - position, first)
+  return compare("seek", ports, expected)
+
+# (name, timeline) of every song to play.
+def load_songs(workloads, songs_location):
+  if songs_location is None:
+    return [(name, compile_midi_file(MidiFile(file = io.BytesIO(synthetic_midi.midi_file_bytes(
+      synthetic_midi.workloads[name]()))), song_name = name)) for name in workloads]
+  songs = []
+  for file_name in sorted(os.listdir(songs_location)):
+    if file_name.lower().endswith(".mid"):
+      songs.append((file_name, compile_midi_file(MidiFile(os.path.join(songs_location, file_name)), song_name = file_name)))
+  return songs
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--workloads", default=",".join(synthetic_midi.workloads))
+  parser.add_argument("--songs_location", help="Directory of .mid files to play instead of the synthetic workloads.")
+  parser.add_argument("--ports", type=int, default=2, help="How many ports to play every song to at once.")
+  args = parser.parse_args()
+
+  songs = load_songs(args.workloads.split(","), args.songs_location)
+  clock = VirtualClock()
+  ports = [RecordingPort(keep_messages = True, clock = clock, name = "recording" + str(i)) for i in range(args.ports)]
+  player = UsbPianoPlayer(output_port = ports, clock = clock)
+
+  problems = []
+  with open(os.devnull, "w") as devnull:
+    for name, timeline in songs:
+      if len(timeline.group_starts()) < 3:
+        print("%-24s skipped, too short" % name)
+        continue
+      song_problems = []
+      virtual_start, start = clock.now(), time.perf_counter()
+      # Playback logging isn't what we're checking.
+      with contextlib.redirect_stdout(devnull):
+        for check in (check_full, check_stop, check_seek):
+          song_problems += check(player, clock, ports, timeline)
+      real_seconds = time.perf_counter() - start
+      virtual_seconds = clock.now() - virtual_start
+      print("%-24s events=%d played=%.1fs real=%.2fs speedup=%.0fx %s" % (name, len(timeline), virtual_seconds,
+        real_seconds, virtual_seconds / real_seconds, "ok" if len(song_problems) == 0 else "FAILED"))
+      problems += [name + " " + problem for problem in song_problems]
+
+  for problem in problems:
+    print(problem)
+  sys.exit(1 if len(problems) > 0 else 0)
@@ -0,0 +1,54 @@
+#
+# benchmark_ports.py
+#
+# Output ports and helpers shared by the benchmarks, so that the
+# player can be measured without a piano plugged in.
+
+import threading
+import time
+
+class NullPort:
+  """
+  Discards every message, but signals when the first one arrives.
+  """
+  name = "null"
+
+  def __init__(self):
+    self.first_send = threading.Event()
+    self.first_send_time = None
+
+  def send(self, msg):
+    if not self.first_send.is_set():
+      self.first_send_time = time.perf_counter()
+      self.first_send.set()
+
+  def reset(self):
+    self.first_send.clear()
+    self.first_send_time = None
+
+class RecordingPort:
+  """
+  Records the time of every send (and optionally the message itself),
+  read off clock if given (i.e. a VirtualClock - see
+  benchmark_offline.py), otherwise the monotonic time.
+  """
+  def __init__(self, keep_messages = False, clock = None, name = "recording"):
+    self.keep_messages = keep_messages
+    self.clock = clock
+    self.name = name
+    self.send_times = []
+    self.messages = []
+
+  def send(self, msg):
+    self.send_times.append(time.monotonic() if self.clock is None else self.clock.now())
+    if self.keep_messages:
+      self.messages.append(msg)
+
+  def reset(self):
+    self.send_times = []
+    self.messages = []
+
+def percentile(samples, p):
+  ordered = sorted(samples)
+  index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+  return ordered[index]
@@ -0,0 +1,86 @@
+#
+# benchmark_preemption.py
+#
+# Measures how long it takes UsbPianoPlayer to stop a song, and to
+# replace a playing song with a new one (time until the new song's
+# first note is sent). Songs are synthetic timelines with long rests
+# so that every stop/replace lands in the middle of a wait. No piano
+# is required - events are sent to a null port.
+#
+# Usage: python3 benchmark_preemption.py [--iterations 200]
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from midi_timeline import MidiTimeline
+from usb_piano_player import UsbPianoPlayer
+from benchmark_ports import NullPort, percentile
+
+# A song that plays one note and then rests for rest_seconds before
+# the next one.
+def make_resting_timeline(rest_seconds = 60.0):
+  timeline = MidiTimeline(song_name = "rest")
+  timeline.append(0.0, [0x90, 60, 64])
+  timeline.append(rest_seconds, [0x80, 60, 0])
+  timeline.duration = rest_seconds
+  return timeline
+
+def report(label, samples):
+  print("%-8s n=%d p50=%.3fms p99=%.3fms max=%.3fms" % (label, len(samples),
+    percentile(samples, 50) * 1000, percentile(samples, 99) * 1000, max(samples) * 1000))
+
+# Time from stop_playing() being called until the player is idle.
+def benchmark_stop(player, port, timeline, iterations):
+  samples = []
+  for _ in range(iterations):
+    port.reset()
+    player.replace_song(song_hash = timeline.song_hash)
+    port.first_send.wait()
+    # Land somewhere inside the rest.
+    time.sleep(random.uniform(0.001, 0.01))
+    start = time.perf_counter()
+    player.stop_playing()
+    samples.append(time.perf_counter() - start)
+  return samples
+
+# Time from replace_song() being called until the new song's first
+# event has been sent.
+def benchmark_replace(player, port, timeline, iterations):
+  samples = []
+  port.reset()
+  player.replace_song(song_hash = timeline.song_hash)
+  port.first_send.wait()
+  for _ in range(iterations):
+    time.sleep(random.uniform(0.001, 0.01))
+    port.reset()
+    start = time.perf_counter()
+    player.replace_song(song_hash = timeline.song_hash)
+    port.first_send.wait()
+    samples.append(port.first_send_time - start)
+  player.stop_playing()
+  return samples
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--iterations", type=int, default=200)
+  args = parser.parse_args()
+
+  port = NullPort()
+  player = UsbPianoPlayer(output_port = port)
+  timeline = make_resting_timeline()
+  timeline.song_hash = "benchmark_preemption"
+  player.song_cache.put(timeline.song_hash, timeline)
+
+  # Playback logging isn't what we're measuring.
+  with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    stop_samples = benchmark_stop(player, port, timeline, args.iterations)
+    replace_samples = benchmark_replace(player, port, timeline, args.iterations)
+
+  report("stop", stop_samples)
+  report("replace", replace_samples)
@@ -0,0 +1,273 @@
+#
+# benchmark_suite.py
+#
+# Runs UsbPianoPlayer against synthetic MIDI workloads (see
+# synthetic_midi.py) with null/recording output ports, so no piano
+# is needed. For every workload it reports:
+#
+#   parse_seconds          MidiFile parse of the raw bytes
+#   compile_seconds        compile_midi_file into a MidiTimeline
+#   compact_seconds        MidiTimeline.compacted, leaving
+#                          compacted_events of the song's events
+#   open_compiled_seconds  mapping the song's compiled file (see
+#                          compiled_song.py)
+#   send_events_per_second playback loop throughput with no waiting
+#   jitter_p50/p99/max     lateness of real-time playback (seconds)
+#   start_song_seconds     /startSong POST to first note, through
+#                          PianoPlayerWebServer (cache disabled)
+#   peak_rss_kb            peak resident memory of the run
+#
+# Separately, startup of usb_piano_player.py itself (as server.js
+# runs it) is measured as the "startup" entry:
+#
+#   listen_seconds         process start until the control socket
+#                          accepts connections
+#   serve_seconds          process start until /status responds
+#
+# Each workload runs in its own process so peak RSS is per workload.
+# Results are written as JSON; pass --baseline to compare against a
+# previous run (exits 1 on regressions beyond --tolerance) and
+# --write_baseline to record a new one.
+#
+# Usage: python3 benchmark_suite.py [--workloads dense_chords,fast_trills]
+#          [--output results.json] [--baseline baseline.json] [--write_baseline]
+
+import argparse
+import contextlib
+import base64
+import io
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+_benchmarks_location = os.path.dirname(os.path.abspath(__file__))
+# usb_piano_player.py is run from here, as server.js does.
+_server_location = os.path.join(_benchmarks_location, "..", "..", "..")
+sys.path.insert(0, os.path.join(_benchmarks_location, ".."))
+
+from benchmark_ports import NullPort, RecordingPort, percentile
+import synthetic_midi
+
+# Metrics where a larger value is better. Everything else is a cost.
+_higher_is_better = ("send_events_per_second",)
+
+# Metrics that describe the workload rather than measure the player,
+# and so are never compared against the baseline.
+_informational = ("events", "duration", "compacted_events")
+
+# Best of several runs, to keep noise out of the timing figures.
+def best_time(function, repeats = 3):
+  best = None
+  result = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+# Real-time playback of the first `seconds` of the timeline, returning
+# the lateness of every event sent.
+def measure_jitter(player_class, timeline, seconds):
+  from midi_timeline import MidiTimeline
+  excerpt = MidiTimeline(song_name = timeline.song_name)
+  for i in range(len(timeline)):
+    if timeline.deadlines[i] > seconds:
+      break
+    excerpt.append(timeline.deadlines[i], timeline.event_bytes(i))
+  excerpt.duration = seconds
+
+  port = RecordingPort()
+  player = player_class(output_port = port)
+  start_time = time.monotonic() + 0.01
+  player.play_timeline(excerpt, start_time = start_time)
+  return [port.send_times[i] - start_time - excerpt.deadlines[i] for i in range(len(port.send_times))]
+
+def free_port():
+  with socket.socket() as probe:
+    probe.bind(("localhost", 0))
+    return probe.getsockname()[1]
+
+# Time from POSTing the song to /startSong until its first note is
+# sent, with the cache disabled so every request decodes and parses.
+def measure_start_song(player_class, server_class, midi_bytes, repeats):
+  port = NullPort()
+  player = player_class(output_port = port, cache_max_entries = 0)
+  application_port = free_port()
+  threading.Thread(target=server_class, args=(application_port, player), daemon=True).start()
+  for _ in range(100):
+    try:
+      with socket.create_connection(("localhost", application_port), timeout = 0.1):
+        break
+    except OSError:
+      time.sleep(0.05)
+
+  body = json.dumps({"song_name": "benchmark", "midi_contents": base64.b64encode(midi_bytes).decode()}).encode()
+  samples = []
+  for _ in range(repeats):
+    player.stop_playing()
+    port.reset()
+    request = urllib.request.Request("http://localhost:%d/startSong" % application_port, data = body,
+      headers = {"Content-Type": "application/json"})
+    start = time.perf_counter()
+    urllib.request.urlopen(request).read()
+    port.first_send.wait(30)
+    samples.append(port.first_send_time - start)
+  player.stop_playing()
+  return percentile(samples, 50)
+
+# Time from starting usb_piano_player.py until its control socket
+# accepts connections, and until it answers /status. Returns the
+# median of each over repeats runs.
+def measure_startup(repeats):
+  listen_samples = []
+  serve_samples = []
+  for _ in range(repeats):
+    application_port = free_port()
+    with tempfile.TemporaryDirectory() as index_location:
+      start = time.perf_counter()
+      player_process = subprocess.Popen([sys.executable, os.path.join(_benchmarks_location, "..", "usb_piano_player.py"),
+        str(application_port), "--library_index", os.path.join(index_location, "library.sqlite3")], cwd = _server_location,
+        stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+      try:
+        while True:
+          try:
+            with socket.create_connection(("localhost", application_port), timeout = 1):
+              break
+          except OSError:
+            if player_process.poll() is not None or time.perf_counter() - start > 30:
+              raise RuntimeError("usb_piano_player.py did not start listening.")
+            time.sleep(0.001)
+        listen_samples.append(time.perf_counter() - start)
+        urllib.request.urlopen("http://localhost:%d/status" % application_port, timeout = 30).read()
+        serve_samples.append(time.perf_counter() - start)
+      finally:
+        player_process.kill()
+        player_process.wait()
+  return {"listen_seconds": percentile(listen_samples, 50), "serve_seconds": percentile(serve_samples, 50)}
+
+# Run a single workload in this process and return its results.
+def run_workload(name, jitter_seconds, start_song_repeats):
+  from mido import MidiFile
+  from midi_timeline import compile_midi_file
+  from compiled_song import load_compiled_song
+  from usb_piano_player import UsbPianoPlayer, PianoPlayerWebServer
+
+  midi_bytes = synthetic_midi.midi_file_bytes(synthetic_midi.workloads[name]())
+  results = {}
+
+  parse_seconds, midi_file = best_time(lambda: MidiFile(file = io.BytesIO(midi_bytes)))
+  compile_seconds, timeline = best_time(lambda: compile_midi_file(midi_file, song_name = name))
+  results["events"] = len(timeline)
+  results["duration"] = timeline.duration
+  results["parse_seconds"] = parse_seconds
+  results["compile_seconds"] = compile_seconds
+  results["compact_seconds"], compacted = best_time(lambda: timeline.compacted())
+  results["compacted_events"] = len(compacted)
+
+  with tempfile.TemporaryDirectory() as songs_location:
+    midi_location = os.path.join(songs_location, name + ".mid")
+    with open(midi_location, "wb") as midi_file:
+      midi_file.write(midi_bytes)
+    # The first load writes the compiled file; after that it's mapped.
+    load_compiled_song(midi_location)
+    results["open_compiled_seconds"], _ = best_time(lambda: load_compiled_song(midi_location))
+
+  # Starting the song far enough in the past that every deadline has
+  # passed makes the loop send as fast as it can.
+  player = UsbPianoPlayer(output_port = NullPort())
+  start = time.perf_counter()
+  player.play_timeline(timeline, start_time = time.monotonic() - timeline.duration - 1)
+  results["send_events_per_second"] = len(timeline) / (time.perf_counter() - start)
+
+  lateness = measure_jitter(UsbPianoPlayer, timeline, jitter_seconds)
+  results["jitter_p50"] = percentile(lateness, 50)
+  results["jitter_p99"] = percentile(lateness, 99)
+  results["jitter_max"] = max(lateness)
+
+  results["start_song_seconds"] = measure_start_song(UsbPianoPlayer, PianoPlayerWebServer, midi_bytes, start_song_repeats)
+  results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return results
+
+# Compare results to a baseline. Returns a list of regression
+# descriptions.
+def compare(results, baseline, tolerance):
+  regressions = []
+  for name, metrics in results.items():
+    for metric, value in metrics.items():
+      previous = baseline.get(name, {}).get(metric)
+      if previous is None or metric in _informational or previous == 0:
+        continue
+      change = (value - previous) / abs(previous)
+      if metric in _higher_is_better:
+        change = -change
+      if change > tolerance:
+        regressions.append("%s.%s: %.6g -> %.6g (%+.0f%%)" % (name, metric, previous, value, change * 100))
+  return regressions
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--workloads", default=",".join(synthetic_midi.workloads))
+  parser.add_argument("--jitter_seconds", type=float, default=3.0)
+  parser.add_argument("--start_song_repeats", type=int, default=5)
+  parser.add_argument("--startup_repeats", type=int, default=5)
+  parser.add_argument("--output", default=os.path.join(_benchmarks_location, "results.json"))
+  parser.add_argument("--baseline", default=os.path.join(_benchmarks_location, "baseline.json"))
+  parser.add_argument("--write_baseline", action="store_true")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression.")
+  parser.add_argument("--run_workload", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run_workload is not None:
+    # Child process: keep the player's logging out of our output.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+      results = run_workload(args.run_workload, args.jitter_seconds, args.start_song_repeats)
+    print(json.dumps(results))
+    sys.exit(0)
+
+  results = {}
+  for name in args.workloads.split(","):
+    print("[INFO] Running workload " + name + "...")
+    child = subprocess.run([sys.executable, os.path.abspath(__file__), "--run_workload", name,
+      "--jitter_seconds", str(args.jitter_seconds), "--start_song_repeats", str(args.start_song_repeats)],
+      stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, check = True)
+    results[name] = json.loads(child.stdout.decode().strip().splitlines()[-1])
+    for metric, value in results[name].items():
+      print("  %-24s %.6g" % (metric, value))
+
+  print("[INFO] Measuring startup...")
+  results["startup"] = measure_startup(args.startup_repeats)
+  for metric, value in results["startup"].items():
+    print("  %-24s %.6g" % (metric, value))
+
+  report = {
+    "python": platform.python_version(),
+    "machine": platform.machine(),
+    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "results": results,
+  }
+  with open(args.output, "w") as output_file:
+    json.dump(report, output_file, indent = 2)
+  print("[INFO] Results written to " + args.output)
+
+  if args.write_baseline:
+    with open(args.baseline, "w") as baseline_file:
+      json.dump(report, baseline_file, indent = 2)
+    print("[INFO] Baseline written to " + args.baseline)
+  elif os.path.exists(args.baseline):
+    with open(args.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for regression in regressions:
+      print("[WARNING] Regression " + regression)
+    if regressions:
+      sys.exit(1)
+    print("[INFO] No regressions against " + args.baseline)
@@ -0,0 +1,136 @@
+#
+# synthetic_midi.py
+#
+# Generates synthetic MIDI files that stress different parts of the
+# player: dense chords (many simultaneous events), fast trills (high
+# event rate), many tracks (merge cost), long durations (drift and
+# memory), heavy tempo changes (tempo map conversion) and redundant
+# events (compaction, see MidiTimeline.compacted). Every generator is
+# deterministic so results are comparable between runs.
+
+import io
+import random
+
+import mido
+
+_ticks_per_beat = 480
+
+def _new_file(track_count):
+  midi_file = mido.MidiFile(ticks_per_beat = _ticks_per_beat)
+  for _ in range(track_count):
+    midi_file.tracks.append(mido.MidiTrack())
+  midi_file.tracks[0].append(mido.MetaMessage("set_tempo", tempo = 500000, time = 0))
+  return midi_file
+
+# Ten-note chords on every eighth note, with the sustain pedal
+# pressed and released every bar.
+def dense_chords(seconds = 60):
+  midi_file = _new_file(1)
+  track = midi_file.tracks[0]
+  rng = random.Random(1)
+  eighth = _ticks_per_beat // 2
+  chords = int(seconds * 4)
+  for i in range(chords):
+    notes = sorted(rng.sample(range(36, 96), 10))
+    if i % 8 == 0:
+      track.append(mido.Message("control_change", control = 64, value = 127, time = 0))
+    for note in notes:
+      track.append(mido.Message("note_on", note = note, velocity = 80, time = 0))
+    track.append(mido.Message("note_off", note = notes[0], velocity = 0, time = eighth))
+    for note in notes[1:]:
+      track.append(mido.Message("note_off", note = note, velocity = 0, time = 0))
+    if i % 8 == 7:
+      track.append(mido.Message("control_change", control = 64, value = 0, time = 0))
+  return midi_file
+
+# Alternating thirty-second notes between two keys.
+def fast_trills(seconds = 60):
+  midi_file = _new_file(1)
+  track = midi_file.tracks[0]
+  step = _ticks_per_beat // 8
+  notes = int(seconds * 16)
+  for i in range(notes):
+    note = 72 if i % 2 == 0 else 74
+    track.append(mido.Message("note_on", note = note, velocity = 70, time = 0))
+    track.append(mido.Message("note_off", note = note, velocity = 0, time = step))
+  return midi_file
+
+# Sixteen tracks (one per channel), each playing its own line.
+def many_tracks(seconds = 60, track_count = 16):
+  midi_file = _new_file(track_count)
+  quarter = _ticks_per_beat
+  beats = int(seconds * 2)
+  for channel, track in enumerate(midi_file.tracks):
+    track.append(mido.Message("program_change", channel = channel, program = channel * 8, time = 0))
+    for beat in range(beats):
+      note = 36 + (channel * 5 + beat) % 60
+      track.append(mido.Message("note_on", channel = channel, note = note, velocity = 60, time = 0))
+      track.append(mido.Message("note_off", channel = channel, note = note, velocity = 0, time = quarter))
+  return midi_file
+
+# A steady melody lasting many minutes.
+def long_duration(seconds = 900):
+  midi_file = _new_file(1)
+  track = midi_file.tracks[0]
+  sixteenth = _ticks_per_beat // 4
+  notes = int(seconds * 8)
+  for i in range(notes):
+    note = 60 + (i * 7) % 24
+    track.append(mido.Message("note_on", note = note, velocity = 64, time = 0))
+    track.append(mido.Message("note_off", note = note, velocity = 0, time = sixteenth))
+  return midi_file
+
+# A tempo change on every beat of a melody, as in rubato-heavy
+# performances exported from a sequencer.
+def tempo_changes(seconds = 60):
+  midi_file = _new_file(1)
+  track = midi_file.tracks[0]
+  rng = random.Random(2)
+  eighth = _ticks_per_beat // 2
+  beats = int(seconds * 2)
+  for i in range(beats):
+    track.append(mido.MetaMessage("set_tempo", tempo = rng.randint(350000, 700000), time = 0))
+    for j in range(2):
+      note = 48 + (i * 3 + j) % 36
+      track.append(mido.Message("note_on", note = note, velocity = 64, time = 0))
+      track.append(mido.Message("note_off", note = note, velocity = 0, time = eighth))
+  return midi_file
+
+# A melody buried in the clutter sequencers export: the program and
+# volume sent again every bar, an expression swell in single steps,
+# a chattering sustain pedal and a note off sent twice for every note.
+def redundant_events(seconds = 60):
+  midi_file = _new_file(1)
+  track = midi_file.tracks[0]
+  rng = random.Random(3)
+  sixteenth = _ticks_per_beat // 4
+  steps = int(seconds * 8)
+  for i in range(steps):
+    if i % 16 == 0:
+      track.append(mido.Message("program_change", program = 0, time = 0))
+      track.append(mido.Message("control_change", control = 7, value = 100, time = 0))
+    if i % 16 < 15:
+      track.append(mido.Message("control_change", control = 64, value = rng.randint(100, 127), time = 0))
+    else:
+      track.append(mido.Message("control_change", control = 64, value = 0, time = 0))
+    track.append(mido.Message("control_change", control = 11, value = 64 + abs(i % 64 - 32), time = 0))
+    note = 60 + (i * 5) % 24
+    track.append(mido.Message("note_on", note = note, velocity = 64, time = 0))
+    track.append(mido.Message("note_off", note = note, velocity = 0, time = sixteenth))
+    track.append(mido.Message("note_on", note = note, velocity = 0, time = 0))
+  return midi_file
+
+workloads = {
+  "dense_chords": dense_chords,
+  "fast_trills": fast_trills,
+  "many_tracks": many_tracks,
+  "long_duration": long_duration,
+  "tempo_changes": tempo_changes,
+  "redundant_events": redundant_events,
+}
+
+# Return the raw bytes of a midi file.
+def midi_file_bytes(midi_file):
+  buffer = io.BytesIO()
+  midi_file.save(file = buffer)
+  return buffer.getvalue()
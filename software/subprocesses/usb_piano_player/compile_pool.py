@@ -0,0 +1,212 @@
+#
+# compile_pool.py
+#
+# Parses and compiles songs in a small pool of worker processes.
+# Parsing a midi file is pure Python, so on one of the player's own
+# threads it holds the GIL for as long as it takes, and a big upload
+# made while a song is playing makes that song stutter. Workers hand
+# compiled songs back in the form compiled_song.py writes to disk -
+# a single flat buffer that the timeline's arrays are views into -
+# rather than as pickled mido objects. A song that is streamed (see
+# midi_stream.py) comes back a slice of its arrays at a time over a
+# pipe, and the slices are appended to the timeline in bulk.
+#
+# Re-indexing the library (see song_library.py) is spread over a
+# worker for every core instead, for as long as it takes.
+#
+# multiprocessing and concurrent.futures are only imported once the
+# first worker is needed, so that they don't slow down startup.
+
+import io
+import os
+import threading
+
+from mido import MidiFile
+from midi_timeline import MidiTimeline, compile_midi_file
+from midi_stream import StreamingTimeline, compile_in_background, compile_in_steps, _lookahead_seconds
+from compiled_song import pack_timeline, unpack_timeline, open_compiled_song, load_compiled_song
+
+# Workers compiling songs for the player. Kept small, so that the
+# rest of the cores are left to playback.
+_max_workers = 2
+
+# Workers are spawned rather than forked: by the time the first song
+# is compiled, the player is full of threads (and the locks they
+# hold).
+_start_method = "spawn"
+
+# A pool of up to max_workers worker processes.
+def _process_pool(max_workers):
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor
+  return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(_start_method))
+
+class CompilePool:
+  def __init__(self, max_workers = _max_workers):
+    self.max_workers = max_workers
+    self._executor = None
+    self._lock = threading.Lock()
+
+  # Start the workers now, so that the first song doesn't wait for
+  # them to start up.
+  def start(self):
+    executor = self._get_executor()
+    for _ in range(self.max_workers):
+      executor.submit(_ready)
+    return self
+
+  def shutdown(self):
+    with self._lock:
+      executor, self._executor = self._executor, None
+    if executor is not None:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def _get_executor(self):
+    with self._lock:
+      if self._executor is None:
+        self._executor = _process_pool(self.max_workers)
+      return self._executor
+
+  # Submit function(*arguments) to a worker. A pool that has broken
+  # (a worker was killed, or ran out of memory) is replaced by a new
+  # one the next time round.
+  def _submit(self, function, *arguments):
+    from concurrent.futures.process import BrokenProcessPool
+    executor = self._get_executor()
+
+    def forget_if_broken(future):
+      if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        self._forget(executor)
+
+    try:
+      future = executor.submit(function, *arguments)
+    except BrokenProcessPool:
+      self._forget(executor)
+      raise
+    future.add_done_callback(forget_if_broken)
+    return future
+
+  def _forget(self, executor):
+    with self._lock:
+      if self._executor is executor:
+        self._executor = None
+
+  # Run function(*arguments) in a worker and return its result.
+  def _run(self, function, *arguments):
+    return self._submit(function, *arguments).result()
+
+  # Run function over every tuple of arguments, returning the results
+  # in order. More than one is spread over a worker for every core.
+  def map(self, function, arguments):
+    if len(arguments) <= 1:
+      return [self._run(function, *argument) for argument in arguments]
+    with _process_pool(min(len(arguments), os.cpu_count() or 1)) as executor:
+      futures = [executor.submit(function, *argument) for argument in arguments]
+      return [future.result() for future in futures]
+
+  # Like compile_midi_file(MidiFile(...)) on midi_bytes, but parsed in
+  # a worker. Raises if the song can't be parsed.
+  def compile_bytes(self, midi_bytes, song_name = None, song_hash = None):
+    timeline = unpack_timeline(self._run(_compile_bytes, midi_bytes), song_name = song_name)
+    timeline.song_hash = song_hash
+    return timeline
+
+  # Like load_compiled_song, but a song whose compiled form is missing
+  # or out of date is compiled (and the compiled form rewritten) in a
+  # worker.
+  def load_file(self, midi_location, song_name = None):
+    timeline = open_compiled_song(midi_location, os.stat(midi_location), song_name = song_name)
+    if timeline is not None:
+      return timeline
+    return unpack_timeline(self._run(_load_file, midi_location), song_name = song_name)
+
+  # Like compile_midi_bytes_incrementally, but compiled in a worker.
+  # The events come back as the worker compiles them and are appended
+  # to the StreamingTimeline on a background thread.
+  def stream_bytes(self, midi_bytes, song_name = None, song_hash = None, lookahead = _lookahead_seconds,
+    on_complete = None):
+    import multiprocessing
+    receiver, sender = multiprocessing.get_context(_start_method).Pipe(duplex=False)
+    future = self._submit(_stream_bytes, sender, midi_bytes, lookahead)
+    # The worker gets its own copy of sender, which is only made once
+    # the task is on its way to it. Closing ours when the task is done
+    # means a worker that dies shows up as the end of the pipe.
+    future.add_done_callback(lambda future: sender.close())
+
+    # The worker sends nothing until it has compiled lookahead seconds
+    # of the song (or all of it), or found that it can't.
+    message = _receive(receiver)
+    if message[0] != "events":
+      print("[DEBUG] UsbPianoPlayer unable to compile song " + str(song_name) + " incrementally: " + str(message[1]))
+      receiver.close()
+      return None
+    timeline = StreamingTimeline(song_name = song_name)
+    timeline.song_hash = song_hash
+    timeline.extend(*message[1:])
+    timeline.publish()
+
+    def next_chunk():
+      message = _receive(receiver)
+      if message[0] == "events":
+        timeline.extend(*message[1:])
+        return None
+      receiver.close()
+      if message[0] == "error":
+        raise RuntimeError(message[1])
+      return message[1]
+
+    compile_in_background(timeline, next_chunk, on_complete = on_complete)
+    return timeline
+
+# The next message from a worker streaming a song.
+def _receive(receiver):
+  try:
+    return receiver.recv()
+  except (EOFError, OSError):
+    return ("error", "The worker compiling the song exited.")
+
+# Worker side of start(): nothing to do but be started.
+def _ready():
+  return True
+
+def _compile_bytes(midi_bytes):
+  return pack_timeline(compile_midi_file(MidiFile(file=io.BytesIO(midi_bytes))))
+
+def _load_file(midi_location):
+  return pack_timeline(load_compiled_song(midi_location))
+
+# Worker side of stream_bytes. Sends ("events", deadlines, offsets,
+# data, group heads, snapshots, tempo, state) with what has been
+# compiled since the last one (the channel state only comes with the
+# last), then ("done", duration) - or ("error", error) if compiling
+# failed.
+def _stream_bytes(connection, midi_bytes, lookahead):
+  timeline = MidiTimeline()
+  # Entries of each array that have been sent. Every timeline starts
+  # with the same first snapshot.
+  sent_events = sent_data = sent_groups = 0
+  sent_snapshots = 1
+
+  def send_events(state = None):
+    nonlocal sent_events, sent_data, sent_groups, sent_snapshots
+    connection.send(("events", timeline.deadlines[sent_events:].tobytes(), timeline.offsets[sent_events + 1:].tobytes(),
+      bytes(timeline.data[sent_data:]), timeline._group_heads[sent_groups:].tobytes(), timeline._snapshots[sent_snapshots:],
+      timeline.tempo, state))
+    sent_events, sent_data = len(timeline.deadlines), len(timeline.data)
+    sent_groups, sent_snapshots = len(timeline._group_heads), len(timeline._snapshots)
+
+  try:
+    compiler = compile_in_steps(timeline, midi_bytes)
+    while len(timeline.deadlines) == 0 or timeline.deadlines[-1] < lookahead:
+      next(compiler)
+    send_events()
+    while True:
+      next(compiler)
+      send_events()
+  except StopIteration as stop:
+    send_events(state = bytes(timeline._state))
+    connection.send(("done", stop.value))
+  except Exception as e:
+    connection.send(("error", str(e)))
+  finally:
+    connection.close()
@@ -0,0 +1,164 @@
+#
+# compiled_song.py
+#
+# On-disk form of a compiled MidiTimeline, kept next to the midi file
+# it came from (song.mid -> song.timeline). Loading it is just an
+# mmap: the timeline's arrays are views straight into the mapped
+# file, so nothing is parsed or copied before the first note is
+# sent. The file records the mtime and size of its source and is
+# regenerated whenever they change.
+#
+# Layout (native byte order, which is recorded in the header):
+#
+#   header         _header, padded to _header_size bytes
+#   deadlines      float64 per event
+#   offsets        uint32 per event, plus one (see MidiTimeline)
+#   group starts   uint32 per group, plus one
+#   snapshots      _state_size bytes each, then the final state
+#   data           packed status/data bytes of every event
+#
+# Every section starts on an 8 byte boundary. The same layout, in a
+# single buffer, is how worker processes hand compiled songs back
+# (see compile_pool.py).
+
+import io
+import mmap
+import os
+import struct
+import sys
+
+from mido import MidiFile
+from midi_timeline import MidiTimeline, compile_midi_file, _state_size
+from song_cache import hash_midi_bytes
+
+# Extension of compiled songs.
+_compiled_extension = ".timeline"
+
+# Bumped whenever the layout changes, so old files are regenerated.
+_magic = b"KTLINE01"
+
+# magic, byte order, source mtime (ns), source size, duration,
+# tempo (0 if unset), sha256 of the source, then the number of
+# events, data bytes, groups and snapshots.
+_header = struct.Struct("<8s8sqqdI64sIIII")
+_header_size = 128
+
+# Where the compiled form of the midi file at midi_location lives.
+def compiled_location(midi_location):
+  return os.path.splitext(midi_location)[0] + _compiled_extension
+
+def _aligned(size):
+  return (size + 7) & ~7
+
+# The compiled form of timeline, as the bytes-like sections to be
+# written one after another. source_stat (if any) is the os.stat
+# result of the midi file it was compiled from.
+def _sections(timeline, source_stat = None):
+  group_starts = timeline.group_starts()
+  snapshots = list(timeline._snapshots) + [timeline._state]
+  header = _header.pack(_magic, sys.byteorder.encode().ljust(8, b"\0"),
+    source_stat.st_mtime_ns if source_stat is not None else 0, source_stat.st_size if source_stat is not None else 0,
+    timeline.duration, timeline.tempo or 0, (timeline.song_hash or "").encode(), len(timeline), len(timeline.data),
+    len(group_starts) - 1, len(snapshots))
+
+  sections = [header.ljust(_header_size, b"\0")]
+  for section in (timeline.deadlines, timeline.offsets, group_starts):
+    section_bytes = section.tobytes()
+    sections.append(section_bytes.ljust(_aligned(len(section_bytes)), b"\0"))
+  sections.extend(snapshots)
+  sections.append(bytes(_aligned(len(snapshots) * _state_size) - len(snapshots) * _state_size))
+  sections.append(timeline.data)
+  return sections
+
+# Write timeline as the compiled form of the midi file at
+# midi_location, whose os.stat result is source_stat. The file is
+# written to the side and moved into place, so songs that are mapped
+# while it is being regenerated keep their (old) contents.
+def write_compiled_song(timeline, midi_location, source_stat):
+  location = compiled_location(midi_location)
+  temporary_location = location + ".tmp"
+  with open(temporary_location, "wb") as compiled_file:
+    compiled_file.writelines(_sections(timeline, source_stat))
+  os.replace(temporary_location, location)
+
+# The compiled form of timeline as a single bytes object, for handing
+# a compiled song from one process to another (see compile_pool.py).
+def pack_timeline(timeline):
+  return b"".join(_sections(timeline))
+
+# Map the compiled form of the midi file at midi_location and return
+# it as a (read-only) MidiTimeline, or None if there is no compiled
+# file or it is out of date with source_stat.
+def open_compiled_song(midi_location, source_stat, song_name = None):
+  location = compiled_location(midi_location)
+  try:
+    with open(location, "rb") as compiled_file:
+      mapping = mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (OSError, ValueError):
+    return None
+  return unpack_timeline(mapping, song_name = song_name, source_stat = source_stat)
+
+# Return the compiled song in buffer (a mapped file, or the result of
+# pack_timeline) as a (read-only) MidiTimeline whose arrays are views
+# into it, or None if it isn't one. If source_stat is given, the song
+# must have been compiled from a file with its mtime and size.
+def unpack_timeline(buffer, song_name = None, source_stat = None):
+  if len(buffer) < _header_size:
+    return None
+  (magic, byte_order, source_mtime_ns, source_size, duration, tempo, song_hash, events, data_bytes, groups,
+    snapshots) = _header.unpack_from(buffer)
+  if magic != _magic or byte_order.rstrip(b"\0").decode() != sys.byteorder:
+    return None
+  if source_stat is not None and (source_mtime_ns != source_stat.st_mtime_ns or source_size != source_stat.st_size):
+    return None
+
+  lengths = [8 * events, 4 * (events + 1), 4 * (groups + 1), snapshots * _state_size]
+  if len(buffer) != _header_size + sum(_aligned(length) for length in lengths) + data_bytes:
+    # Truncated or otherwise damaged. 
+    return None
+
+  view = memoryview(buffer)
+  position = _header_size
+
+  # The next section of the buffer, as a view of the given typecode.
+  def section(length, typecode):
+    nonlocal position
+    start = position
+    position += _aligned(length)
+    return view[start:start + length].cast(typecode)
+
+  timeline = MidiTimeline(song_name = song_name)
+  timeline.song_hash = song_hash.rstrip(b"\0").decode() or None
+  timeline.duration = duration
+  timeline.tempo = tempo or None
+  timeline.deadlines = section(8 * events, "d")
+  timeline.offsets = section(4 * (events + 1), "I")
+  timeline._group_starts = section(4 * (groups + 1), "I")
+  timeline._group_heads = timeline._group_starts[:groups]
+  state_bytes = section(snapshots * _state_size, "B")
+  timeline._snapshots = [state_bytes[k * _state_size:(k + 1) * _state_size] for k in range(snapshots - 1)]
+  timeline._state = state_bytes[(snapshots - 1) * _state_size:]
+  timeline.data = section(data_bytes, "B")
+  return timeline
+
+# Return the timeline of the midi file at midi_location, mapping its
+# compiled form if it is up to date. Otherwise the midi file is
+# parsed and compiled, and the compiled form (re)written for next
+# time. Raises if the midi file can't be read or parsed.
+def load_compiled_song(midi_location, song_name = None):
+  source_stat = os.stat(midi_location)
+  timeline = open_compiled_song(midi_location, source_stat, song_name = song_name)
+  if timeline is not None:
+    return timeline
+
+  print("[DEBUG] UsbPianoPlayer compiling song located: " + str(midi_location) + ".")
+  with open(midi_location, "rb") as midi_file:
+    midi_bytes = midi_file.read()
+  timeline = compile_midi_file(MidiFile(file=io.BytesIO(midi_bytes)), song_name = song_name)
+  timeline.song_hash = hash_midi_bytes(midi_bytes)
+  try:
+    write_compiled_song(timeline, midi_location, source_stat)
+  except OSError as e:
+    print("[WARNING] UsbPianoPlayer was unable to save the compiled form of '" + str(midi_location) + "'. Exception: ")
+    print(e)
+  return timeline
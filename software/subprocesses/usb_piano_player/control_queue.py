@@ -0,0 +1,112 @@
+#
+# control_queue.py
+#
+# Runs the player's control commands (start, stop, pause, seek...)
+# one at a time on a single worker thread. Handling them on the web
+# server's own thread meant waiting there for the current song to
+# stop, holding up every other request, and a burst of starts each
+# preempted the song the one before had started. Commands wait in a
+# bounded queue instead; once it is full, more are refused so the
+# caller can turn them away rather than buffer them. A command that
+# replaces the current song supersedes every command still waiting,
+# so after a burst of starts only the last one stops what is playing
+# and has its song decoded.
+
+from collections import deque
+import threading
+
+# Commands that may be waiting at once.
+_max_pending = 16
+
+class ControlCommand:
+  """
+  A command submitted to a ControlQueue. Once done is set, result
+  holds what function returned - unless the command was superseded
+  by a newer one before it could run, or raised error.
+  """
+  def __init__(self, function, replaces_pending = False):
+    self.function = function
+    self.replaces_pending = replaces_pending
+    self.result = None
+    self.error = None
+    self.superseded = False
+    self.done = threading.Event()
+
+    self._callbacks = []
+    self._lock = threading.Lock()
+
+  # Block until the command has run or been superseded. Returns its
+  # result.
+  def wait(self, timeout = None):
+    self.done.wait(timeout)
+    return self.result
+
+  # Call callback once the command has run or been superseded (on the
+  # thread that finished it), or right away if it already has.
+  def add_done_callback(self, callback):
+    with self._lock:
+      if not self.done.is_set():
+        self._callbacks.append(callback)
+        return
+    callback()
+
+  def finish(self):
+    with self._lock:
+      self.done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      callback()
+
+class ControlQueue:
+  def __init__(self, max_pending = _max_pending):
+    self.max_pending = max_pending
+    # Commands superseded and refused so far.
+    self.superseded = 0
+    self.rejected = 0
+
+    self._pending = deque()
+    self._condition = threading.Condition()
+    self._worker = threading.Thread(target=self._run, daemon=True)
+    self._worker.start()
+
+  def __len__(self):
+    return len(self._pending)
+
+  # Queue function() to be run on the worker. If replaces_pending is
+  # set, every command still waiting is dropped in its favour. Returns
+  # the ControlCommand, or None if the queue is full.
+  def submit(self, function, replaces_pending = False):
+    with self._condition:
+      if replaces_pending:
+        while self._pending:
+          command = self._pending.popleft()
+          command.superseded = True
+          command.finish()
+          self.superseded += 1
+      elif len(self._pending) >= self.max_pending:
+        self.rejected += 1
+        return None
+      command = ControlCommand(function, replaces_pending)
+      self._pending.append(command)
+      self._condition.notify()
+      return command
+
+  # Whether a command that replaces the ones before it is waiting to
+  # run, i.e. so that the command being run can give way to it.
+  def replacement_pending(self):
+    with self._condition:
+      return any(command.replaces_pending for command in self._pending)
+
+  def _run(self):
+    while True:
+      with self._condition:
+        while not self._pending:
+          self._condition.wait()
+        command = self._pending.popleft()
+      try:
+        command.result = command.function()
+      except Exception as e:
+        print("[ERROR] ControlQueue ran into an exception while running a command! Exception: ")
+        print(e)
+        command.error = e
+      command.finish()
@@ -0,0 +1,138 @@
+#
+# midi_output.py
+#
+# Writers that put the events of a compiled MidiTimeline onto an
+# output port, one group of simultaneous events (i.e. a chord) at a
+# time. Which writer is used depends on what the port supports:
+#
+#   RawDeviceWriter  A raw MIDI device node (i.e. ALSA's
+#                    /dev/snd/midiC1D0). The whole group is written
+#                    with a single os.write, using running status.
+#   RtMidiWriter     mido's rtmidi backend. Each event is handed to
+#                    rtmidi as raw bytes, skipping mido's Message
+#                    construction and copying.
+#   MidoPortWriter   Any other mido port (or stand-in with a send
+#                    method). Each event goes through port.send.
+#
+# Each group is prepared ahead of time by the producer (encode_group)
+# and written by the real-time sender thread (write) - see
+# realtime_sender.py.
+#
+# A song can be played to several ports at once; each is a 
+# PortOutput with its own writer and sender, and optionally only some
+# of the song's channels routed to it.
+
+import os
+
+import mido
+
+class MidoPortWriter:
+  def __init__(self, port):
+    self.port = port
+
+  # Prepare group g of the timeline, which holds events [start, end),
+  # for write().
+  def encode_group(self, timeline, g, start, end):
+    return [timeline.event_message(i) for i in range(start, end)]
+
+  def write(self, payload):
+    port = self.port
+    for msg in payload:
+      port.send(msg)
+
+  def close(self):
+    pass
+
+class RtMidiWriter:
+  def __init__(self, port):
+    self.port = port
+    self._rt = port._rt
+
+  def encode_group(self, timeline, g, start, end):
+    return [bytes(timeline.event_bytes(i)) for i in range(start, end)]
+
+  def write(self, payload):
+    send_message = self._rt.send_message
+    for message_bytes in payload:
+      send_message(message_bytes)
+
+  def close(self):
+    pass
+
+class RawDeviceWriter:
+  """
+  Writes straight to a raw MIDI device node. Running status within a
+  group is valid on a raw byte stream, so each chord is a single,
+  shorter write.
+  """
+  def __init__(self, device_location):
+    self.device_location = device_location
+    self._fd = os.open(device_location, os.O_WRONLY)
+
+  def encode_group(self, timeline, g, start, end):
+    return bytes(timeline.group_bytes(g))
+
+  def write(self, payload):
+    os.write(self._fd, payload)
+
+  def close(self):
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+class PortOutput:
+  """
+  One output port along with the writer and real-time sender that
+  feed it. If channels is given, only events on those MIDI channels
+  (0-15) are routed to the port; system messages always are.
+  """
+  def __init__(self, name, port, writer, sender, channels = None):
+    self.name = name
+    self.port = port
+    self.writer = writer
+    self.sender = sender
+    self.channels = channels
+    # False while the port has gone away (see port_watcher.py). 
+    self.connected = True
+
+  # The version of timeline to play on this port.
+  def route(self, timeline):
+    if self.channels is None:
+      return timeline
+    return timeline.filtered(self.channels)
+
+# Parse a channel routing specification of the form
+# "port name=0-8,10;other port=9" into a dict of port name to the set
+# of channels (0-15) routed to it. Raises ValueError if malformed.
+def parse_channel_routing(specification):
+  routing = {}
+  for entry in specification.split(";"):
+    if entry.strip() == "":
+      continue
+    name, _, channel_list = entry.rpartition("=")
+    if name == "":
+      raise ValueError("Expected 'port name=channels', got '" + entry + "'.")
+    channels = set()
+    for channel_range in channel_list.split(","):
+      first, _, last = channel_range.partition("-")
+      for channel in range(int(first), int(last or first) + 1):
+        if not 0 <= channel <= 15:
+          raise ValueError("MIDI channels are 0-15, got " + str(channel) + ".")
+        channels.add(channel)
+    routing[name.strip()] = frozenset(channels)
+  return routing
+
+# Pick the fastest writer the port supports. If raw_device_location
+# is given and can be opened, it is used instead of the port.
+def make_port_writer(port, raw_device_location = None):
+  if raw_device_location is not None:
+    try:
+      writer = RawDeviceWriter(raw_device_location)
+      print("[INFO] UsbPianoPlayer writing batches directly to " + str(raw_device_location) + ".")
+      return writer
+    except OSError as e:
+      print("[WARNING] UsbPianoPlayer was unable to open raw device '" + str(raw_device_location) + "'. Exception: ")
+      print(e)
+  if isinstance(port, mido.ports.BaseOutput) and hasattr(port, "_rt") and hasattr(port._rt, "send_message"):
+    return RtMidiWriter(port)
+  return MidoPortWriter(port)
@@ -0,0 +1,346 @@
+#
+# midi_stream.py
+#
+# Incremental compilation of a midi file, so a song can start playing
+# before all of it has been parsed. Parsing a large multi-track file
+# with mido means building a Message for every event of every track
+# and merging them all before the first note can be sent. Here the
+# chunks are only located up front; each track is parsed lazily, and
+# the tracks are merged in time order as they are read. Once the
+# first lookahead seconds of the song have been compiled the
+# (still growing) timeline is handed back to be played, and the rest
+# is compiled on a background thread, well ahead of playback.
+#
+# The result is the same as compile_midi_file(MidiFile(...)): the
+# tracks are merged the way mido merges them and ticks are converted
+# to seconds the way mido converts them, so the deadlines come out
+# identical. Files this doesn't handle (SMPTE timing, anything
+# malformed before playback starts) are left to mido.
+
+import heapq
+import threading
+
+from midi_timeline import MidiTimeline, _append_running_status
+
+# Seconds of the song compiled before it starts playing.
+_lookahead_seconds = 2.0
+
+# How many events are compiled between handing them out to playback.
+_publish_interval = 256
+
+# Microseconds per beat until the song sets its tempo (120 bpm).
+_default_tempo = 500000
+
+# Number of data bytes after the status byte of system common and
+# real-time messages, as mido reads them. Anything else (other than
+# sysex and meta messages) is undefined.
+_system_message_lengths = {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}
+
+_set_tempo = 0x51
+_end_of_track = 0x2F
+
+class StreamingTimeline(MidiTimeline):
+  """
+  A MidiTimeline that is still being compiled on another thread. The
+  events compiled so far can be read as usual; groups() waits for
+  the rest as they are finished, and anything that needs the whole
+  song (transformed, filtered, compacted) waits for the compile to
+  complete.
+  duration is the deadline of the last compiled event until then, and
+  known_duration() is None.
+  """
+  def __init__(self, song_name = None):
+    super().__init__(song_name = song_name)
+    self.complete = False
+    # Set if compiling failed part of the way through.
+    self.error = None
+    # Number of groups that can no longer change.
+    self._finished_groups = 0
+    self._condition = threading.Condition()
+
+  # Compiler side: hand out every group but the last, which may still
+  # get more events.
+  def publish(self):
+    with self._condition:
+      self._finished_groups = max(len(self._group_heads) - 1, 0)
+      if len(self.deadlines) > 0:
+        self.duration = self.deadlines[-1]
+      self._condition.notify_all()
+
+  # Compiler side: append events compiled somewhere else (see
+  # compile_pool.py) in bulk. deadlines, offsets, data and group_heads
+  # are the raw bytes of the new entries of each array, and snapshots
+  # the new snapshots; state is the channel state after them, if it's
+  # known. Nothing is handed out until the next publish().
+  def extend(self, deadlines, offsets, data, group_heads, snapshots, tempo = None, state = None):
+    self.data.extend(data)
+    self.offsets.frombytes(offsets)
+    self._group_heads.frombytes(group_heads)
+    self._snapshots.extend(snapshots)
+    self.deadlines.frombytes(deadlines)
+    if self.tempo is None:
+      self.tempo = tempo
+    if state is not None:
+      self._state[:] = state
+
+  # Compiler side: everything has been compiled (or compiling failed
+  # with error).
+  def finish(self, duration, error = None):
+    with self._condition:
+      self.duration = duration
+      self.error = error
+      self._finished_groups = len(self._group_heads)
+      self._group_starts = None
+      self.complete = True
+      self._condition.notify_all()
+
+  def known_duration(self):
+    return self.duration if self.complete else None
+
+  # Block until the compile is complete.
+  def wait_until_complete(self):
+    with self._condition:
+      while not self.complete:
+        self._condition.wait()
+
+  # Block until at least count groups are finished (or there will
+  # never be that many). Returns the number finished.
+  def wait_for_groups(self, count):
+    with self._condition:
+      while self._finished_groups < count and not self.complete:
+        self._condition.wait()
+      return self._finished_groups
+
+  def groups(self, first_group = 0):
+    g = first_group
+    while True:
+      finished = self.wait_for_groups(g + 1)
+      if finished <= g:
+        return
+      group_heads = self._group_heads
+      for g in range(g, finished):
+        end = group_heads[g+1] if g + 1 < len(group_heads) else len(self.deadlines)
+        yield g, group_heads[g], end
+      g = finished
+
+  def group_at(self, seconds):
+    with self._condition:
+      while not self.complete and (len(self.deadlines) == 0 or self.deadlines[-1] <= seconds):
+        self._condition.wait()
+    return super().group_at(seconds)
+
+  def group_bytes(self, g):
+    if self.complete:
+      return super().group_bytes(g)
+    # Batching the whole song would have to be redone as it grows, so
+    # encode just this group.
+    group_heads = self._group_heads
+    batch = bytearray()
+    _append_running_status(batch, self.data, self.offsets, group_heads[g], group_heads[g+1])
+    return batch
+
+  def transformed(self, tempo_factor = 1.0, transpose = 0):
+    self.wait_until_complete()
+    return super().transformed(tempo_factor, transpose)
+
+  def filtered(self, channels):
+    self.wait_until_complete()
+    return super().filtered(channels)
+
+  def compacted(self, tolerance = 0):
+    self.wait_until_complete()
+    return super().compacted(tolerance)
+
+# Read a variable length quantity at position. Returns it and the
+# position after it.
+def _read_varlen(data, position):
+  value = 0
+  while True:
+    byte = data[position]
+    position += 1
+    value = (value << 7) | (byte & 0x7F)
+    if byte < 0x80:
+      return value, position
+
+# Read the header of a midi file and locate its tracks. Returns the
+# ticks per beat and the (start, end) of every track's events. Raises
+# ValueError for files that should be left to mido.
+def _read_chunks(midi_bytes):
+  if len(midi_bytes) < 14 or midi_bytes[0:4] != b"MThd":
+    raise ValueError("MThd not found.")
+  header_size = int.from_bytes(midi_bytes[4:8], "big")
+  if header_size < 6:
+    raise ValueError("MThd is too short.")
+  track_count = int.from_bytes(midi_bytes[10:12], "big")
+  ticks_per_beat = int.from_bytes(midi_bytes[12:14], "big")
+  if ticks_per_beat & 0x8000 or ticks_per_beat == 0:
+    raise ValueError("SMPTE timing is not supported.")
+
+  tracks = []
+  position = 8 + header_size
+  for _ in range(track_count):
+    if midi_bytes[position:position+4] != b"MTrk" or position + 8 > len(midi_bytes):
+      raise ValueError("No MTrk header at start of track.")
+    size = int.from_bytes(midi_bytes[position+4:position+8], "big")
+    start = position + 8
+    if start + size > len(midi_bytes):
+      raise ValueError("Track is truncated.")
+    tracks.append((start, start + size))
+    position = start + size
+  return ticks_per_beat, tracks
+
+# Parse the events of one track, lazily. Yields (tick, message bytes)
+# with the tick counted from the start of the song; meta messages
+# are 0xFF, their type, then their data.
+def _track_events(data, start, end):
+  tick = 0
+  position = start
+  running_status = None
+  while position < end:
+    delta, position = _read_varlen(data, position)
+    tick += delta
+    status = data[position]
+    if status < 0x80:
+      if running_status is None:
+        raise ValueError("Running status without a previous status.")
+      status = running_status
+      if status == 0xF0 or status == 0xF7:
+        # mido drops the byte it peeked at.
+        position += 1
+    else:
+      position += 1
+      if status != 0xFF:
+        # Meta messages don't set running status.
+        running_status = status
+
+    if status == 0xFF:
+      meta_type = data[position]
+      length, position = _read_varlen(data, position + 1)
+      yield tick, bytes([0xFF, meta_type]) + data[position:position+length]
+    elif status == 0xF0 or status == 0xF7:
+      length, position = _read_varlen(data, position)
+      sysex = data[position:position+length]
+      if len(sysex) > 0 and sysex[-1] == 0xF7:
+        sysex = sysex[:-1]
+      if any(byte > 127 for byte in sysex):
+        raise ValueError("Sysex data bytes must be in range 0..127.")
+      yield tick, b"\xF0" + sysex + b"\xF7"
+    else:
+      if status < 0xF0:
+        length = 1 if 0xC0 <= status < 0xE0 else 2
+      elif status in _system_message_lengths:
+        length = _system_message_lengths[status]
+      else:
+        raise ValueError("Undefined status byte 0x%02x." % status)
+      message = data[position:position+length]
+      if len(message) < length or any(byte > 127 for byte in message):
+        raise ValueError("Data bytes must be in range 0..127.")
+      yield tick, bytes([status]) + message
+    position += length
+  if position != end:
+    raise ValueError("Track overruns its chunk.")
+
+# Compile the merged events into timeline, converting ticks to
+# seconds through the tempo map. Yields every _publish_interval
+# events so that the caller can stop part of the way through;
+# returns the duration of the song.
+def _compile_events(timeline, events, ticks_per_beat):
+  tempo = _default_tempo
+  now = 0.0
+  last_tick = 0
+  end_tick = 0
+  count = 0
+  for tick, message_bytes in events:
+    if message_bytes[0] == 0xFF and message_bytes[1] == _end_of_track:
+      # mido merges every track's end of track into a single one at
+      # the end of the song.
+      end_tick = max(end_tick, tick)
+      continue
+    if tick > last_tick:
+      now += (tick - last_tick) * (tempo * 1e-6 / ticks_per_beat)
+      last_tick = tick
+    if message_bytes[0] == 0xFF:
+      if message_bytes[1] == _set_tempo:
+        if len(message_bytes) < 5:
+          raise ValueError("set_tempo is too short.")
+        tempo = int.from_bytes(message_bytes[2:5], "big")
+        if timeline.tempo is None:
+          timeline.tempo = tempo
+      continue
+    timeline.append(now, message_bytes)
+    count += 1
+    if count % _publish_interval == 0:
+      yield
+  if end_tick > last_tick:
+    now += (end_tick - last_tick) * (tempo * 1e-6 / ticks_per_beat)
+  return now
+
+# Start compiling the midi file in midi_bytes into timeline. Returns
+# a generator that compiles the next _publish_interval events each
+# time it is advanced, and returns the duration of the song once it
+# is done. Raises ValueError for files that should be left to mido.
+def compile_in_steps(timeline, midi_bytes):
+  ticks_per_beat, tracks = _read_chunks(midi_bytes)
+  # Ties go to the earlier track, as they do in mido's merge.
+  events = heapq.merge(*[_track_events(midi_bytes, start, end) for start, end in tracks], key=lambda event: event[0])
+  return _compile_events(timeline, events, ticks_per_beat)
+
+# Compile the midi file in midi_bytes far enough to start playing it
+# (lookahead seconds) and return the StreamingTimeline, compiling the
+# rest on a background thread. on_complete(timeline) is called once
+# the whole song has been compiled. Returns None if the file should
+# be parsed by mido instead (see above).
+def compile_midi_bytes_incrementally(midi_bytes, song_name = None, song_hash = None, lookahead = _lookahead_seconds,
+  on_complete = None):
+  timeline = StreamingTimeline(song_name = song_name)
+  timeline.song_hash = song_hash
+  try:
+    compiler = compile_in_steps(timeline, midi_bytes)
+    while len(timeline.deadlines) == 0 or timeline.deadlines[-1] < lookahead:
+      next(compiler)
+  except StopIteration as stop:
+    # The whole song fit in the lookahead.
+    timeline.finish(stop.value)
+    if on_complete is not None:
+      on_complete(timeline)
+    return timeline
+  except (ValueError, IndexError) as e:
+    print("[DEBUG] UsbPianoPlayer unable to compile song " + str(song_name) + " incrementally: " + str(e))
+    return None
+  timeline.publish()
+
+  def next_chunk():
+    try:
+      next(compiler)
+    except StopIteration as stop:
+      return stop.value
+    return None
+
+  compile_in_background(timeline, next_chunk, on_complete = on_complete)
+  return timeline
+
+# Compile the rest of timeline on a background thread, a chunk at a
+# time: next_chunk() adds the next events to timeline and returns
+# None, or the duration of the song once there are none left. Each
+# chunk is handed out to playback as it is done. on_complete(timeline)
+# is called once the whole song has been compiled. If next_chunk 
+# raises, the song ends with what has been compiled so far.
+def compile_in_background(timeline, next_chunk, on_complete = None):
+  def run():
+    try:
+      while True:
+        duration = next_chunk()
+        if duration is not None:
+          break
+        timeline.publish()
+    except Exception as e:
+      # Too late to hand it to mido; play what we have.
+      print("[ERROR] UsbPianoPlayer was unable to compile the rest of song " + str(timeline.song_name) + ". Exception: ")
+      print(e)
+      timeline.finish(timeline.deadlines[-1] if len(timeline.deadlines) > 0 else 0.0, error = e)
+      return
+    timeline.finish(duration)
+    if on_complete is not None:
+      on_complete(timeline)
+
+  threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,463 @@
+#
+# midi_timeline.py
+#
+# Compiles a mido MidiFile into a flat, array-backed timeline that
+# the UsbPianoPlayer can play without touching mido's track merging
+# or tempo map again. Every playable (non-meta) message is reduced
+# to an absolute deadline (seconds from the start of the song) and
+# its raw status/data bytes, packed back to back in a single
+# bytearray. Events sharing a deadline (chords, pedal changes) form
+# a group that is written to the port in one go.
+#
+# To allow seeking, the timeline also keeps a snapshot of every
+# channel's controller/program/pitch bend state every
+# _snapshot_interval events, so the state at any point in the song
+# can be rebuilt without replaying it from the start.
+#
+# Songs exported from sequencers are often full of events that change
+# nothing - the same controller value sent again, pedal chatter, 
+# repeated program changes, note offs for notes that aren't playing.
+# compacted() drops them, so that less is sent over the USB link.
+
+from array import array
+import bisect
+import copy
+
+import mido
+
+# Number of events between snapshots of the channel state. 
+_snapshot_interval = 1024
+
+# Controllers that are not restored when seeking. Data entry and
+# (N)RPN selection only mean something as part of a sequence, and
+# 120-127 are channel mode messages rather than state. 
+_untracked_controllers = frozenset([6, 38, 96, 97, 98, 99, 100, 101] + list(range(120, 128)))
+
+# Controllers that compacted() may thin out within its tolerance: the
+# MSB of continuous controllers (not bank select) and the single byte
+# ones, less portamento control (which is a note number). Everything
+# else is only dropped if it repeats the value exactly. 
+_continuous_controllers = frozenset(range(1, 32)) | (frozenset(range(64, 96)) - {84})
+
+# On/off pedals (sustain, portamento, sostenuto, soft, legato, hold
+# 2). Thinning them out never crosses between on (64 and up) and off.
+_switch_controllers = frozenset(range(64, 70))
+
+# Layout of a channel state snapshot: 128 controller values per
+# channel, then the program of every channel, then the pitch bend
+# (lsb, msb) of every channel. _unset marks values the song hasn't
+# set (yet). 
+_program_offset = 16 * 128
+_pitch_bend_offset = _program_offset + 16
+_state_size = _pitch_bend_offset + 16 * 2
+_unset = 0xFF
+
+# General MIDI's default volume and pan, for reset_messages.
+_default_volume = 100
+_default_pan = 64
+
+class MidiTimeline:
+  """
+  A compiled song. Event i is played at deadlines[i] seconds after
+  the song starts and consists of the raw MIDI bytes
+  data[offsets[i]:offsets[i+1]].
+
+  Group g holds events group_starts()[g] up to (but excluding)
+  group_starts()[g+1], all of which share a deadline.
+  """
+  def __init__(self, song_name = None):
+    self.song_name = song_name
+    # sha256 of the source midi bytes, if known.
+    self.song_hash = None
+    # Absolute deadline of every event, in seconds.
+    self.deadlines = array("d")
+    # Start offset of every event in data, plus a trailing offset
+    # marking the end of the last event.
+    self.offsets = array("I", [0])
+    # Packed status + data bytes of every event.
+    self.data = bytearray()
+    # Total length of the song, including any trailing meta
+    # messages (i.e. end of track) after the last event.
+    self.duration = 0.0
+    # How much faster than the source song this timeline plays, and
+    # by how many semitones it is transposed - see transformed(). 
+    self.tempo_factor = 1.0
+    self.transpose = 0
+    # Initial tempo of the source song in microseconds per beat, if it
+    # sets one. 
+    self.tempo = None
+    # Number of events the song had before compacted() dropped the 
+    # redundant ones, or None if it hasn't been compacted. 
+    self.compacted_from = None
+
+    # Index of the first event of every group, kept up to date by
+    # append().
+    self._group_heads = array("I")
+    # Built on first use by group_starts() and group_bytes().
+    self._group_starts = None
+    self._batch_offsets = None
+    self._batches = None
+
+    # Channel state after every event appended so far, and a copy of
+    # it taken every _snapshot_interval events (snapshot k is the 
+    # state before event k * _snapshot_interval). 
+    self._state = bytearray([_unset]) * _state_size
+    self._snapshots = [bytes(self._state)]
+
+  def __len__(self):
+    return len(self.deadlines)
+
+  # duration, or None while it isn't known yet (see 
+  # midi_stream.StreamingTimeline).
+  def known_duration(self):
+    return self.duration
+
+  # Append a single event. Deadlines must be non-decreasing.
+  def append(self, deadline, message_bytes):
+    if not self.deadlines or self.deadlines[-1] != deadline:
+      self._group_heads.append(len(self.deadlines))
+    self.deadlines.append(deadline)
+    self.data.extend(message_bytes)
+    self.offsets.append(len(self.data))
+    self._group_starts = None
+    self._batches = None
+    if 0xB0 <= message_bytes[0] < 0xF0:
+      _apply_to_state(self._state, message_bytes)
+    if len(self.deadlines) % _snapshot_interval == 0:
+      self._snapshots.append(bytes(self._state))
+
+  # Approximate memory held by the compiled arrays, in bytes.
+  def nbytes(self):
+    size = (len(self.deadlines) * self.deadlines.itemsize
+      + len(self.offsets) * self.offsets.itemsize
+      + len(self.data))
+    size += len(self._group_heads) * self._group_heads.itemsize
+    size += len(self._snapshots) * _state_size
+    if self._batches is not None:
+      size += len(self._batch_offsets) * self._batch_offsets.itemsize + len(self._batches)
+    return size
+
+  # Index of the first event of every group of simultaneous events,
+  # plus a trailing len(self). 
+  def group_starts(self):
+    if self._group_starts is None:
+      self._group_starts = self._group_heads + array("I", [len(self.deadlines)])
+    return self._group_starts
+
+  # Yield (g, start, end) for every group from first_group on, where
+  # group g holds events [start, end). 
+  def groups(self, first_group = 0):
+    group_starts = self.group_starts()
+    for g in range(first_group, len(group_starts) - 1):
+      yield g, group_starts[g], group_starts[g+1]
+
+  # The raw bytes of group g as one buffer, with running status
+  # applied (repeated channel status bytes dropped) for writing to a
+  # raw MIDI byte stream.
+  def group_bytes(self, g):
+    if self._batches is None:
+      self._build_batches()
+    return self._batches[self._batch_offsets[g]:self._batch_offsets[g+1]]
+
+  def _build_batches(self):
+    group_starts = self.group_starts()
+    batch_offsets = array("I", [0])
+    batches = bytearray()
+    for g in range(len(group_starts) - 1):
+      _append_running_status(batches, self.data, self.offsets, group_starts[g], group_starts[g+1])
+      batch_offsets.append(len(batches))
+    self._batch_offsets = batch_offsets
+    self._batches = batches
+
+  # Return a copy of the song played tempo_factor times as fast as the
+  # source song and transposed by transpose semitones. Both are 
+  # relative to the source song, not to this timeline. The copy is 
+  # made in a single pass over the compiled arrays (the deadlines are
+  # scaled with one map over the array, the notes shifted through a 
+  # lookup table), leaving this timeline untouched since it may be 
+  # shared through the song cache. 
+  def transformed(self, tempo_factor = 1.0, transpose = 0):
+    timeline = MidiTimeline(song_name = self.song_name)
+    timeline.song_hash = self.song_hash
+    timeline.tempo_factor = tempo_factor
+    timeline.transpose = transpose
+    timeline.tempo = self.tempo
+    timeline.compacted_from = self.compacted_from
+
+    scale = self.tempo_factor / tempo_factor
+    if scale == 1.0:
+      timeline.deadlines = array("d", self.deadlines)
+    else:
+      # Scaling by a positive factor keeps the deadlines in order and
+      # simultaneous events simultaneous, so the groups and state
+      # snapshots carry over unchanged. 
+      timeline.deadlines = array("d", map(scale.__mul__, self.deadlines))
+    timeline.duration = self.duration * scale
+    timeline.offsets = array("I", self.offsets)
+    timeline.data = bytearray(self.data)
+    timeline._group_heads = array("I", self._group_heads)
+    timeline._state = bytearray(self._state)
+    timeline._snapshots = list(self._snapshots)
+
+    if transpose != self.transpose:
+      _transpose_notes(timeline.data, timeline.offsets, transpose - self.transpose)
+    return timeline
+
+  # Return the song under another name. The copy shares the compiled
+  # arrays (which are never changed once compiled) rather than 
+  # copying them, so that a song pulled out of the cache can be 
+  # played as whatever it was requested as without touching the 
+  # cached timeline. 
+  def renamed(self, song_name):
+    if song_name is None or song_name == self.song_name:
+      return self
+    timeline = copy.copy(self)
+    timeline.song_name = song_name
+    return timeline
+
+  # Return a copy of the song holding only the events on the given
+  # MIDI channels (0-15), plus any system messages. 
+  def filtered(self, channels):
+    timeline = MidiTimeline(song_name = self.song_name)
+    timeline.song_hash = self.song_hash
+    timeline.tempo_factor = self.tempo_factor
+    timeline.transpose = self.transpose
+    timeline.tempo = self.tempo
+    deadlines = self.deadlines
+    data = self.data
+    offsets = self.offsets
+    for i in range(len(deadlines)):
+      status = data[offsets[i]]
+      if status >= 0xF0 or (status & 0x0F) in channels:
+        timeline.append(deadlines[i], data[offsets[i]:offsets[i+1]])
+    timeline.duration = self.duration
+    return timeline
+
+  # Return a copy of the song without the events that wouldn't change
+  # anything: controller changes, program changes, pitch bends and
+  # channel pressure that repeat the value the channel already has,
+  # and note offs for notes that aren't playing. With a tolerance, 
+  # continuous controllers, pitch bend (in steps of 128) and channel
+  # pressure are only sent again once they have moved more than 
+  # tolerance away from the value last sent, so sweeps are thinned
+  # out but the piano is never more than tolerance off. 
+  def compacted(self, tolerance = 0):
+    timeline = MidiTimeline(song_name = self.song_name)
+    timeline.song_hash = self.song_hash
+    timeline.tempo_factor = self.tempo_factor
+    timeline.transpose = self.transpose
+    timeline.tempo = self.tempo
+    deadlines = self.deadlines
+    data = self.data
+    offsets = self.offsets
+    # Value last sent for each status (and controller) as status << 8
+    # | controller, and how many note ons every (channel, note) has had
+    # without a note off. 
+    values = {}
+    playing = bytearray(16 * 128)
+    for i in range(len(deadlines)):
+      message_bytes = data[offsets[i]:offsets[i+1]]
+      if not _is_redundant(message_bytes, values, playing, tolerance):
+        timeline.append(deadlines[i], message_bytes)
+    timeline.duration = self.duration
+    timeline.compacted_from = len(self)
+    return timeline
+
+  # Index of the first event at or after the given number of seconds
+  # into the song (len(self) if there is none). 
+  def event_at(self, seconds):
+    return bisect.bisect_left(self.deadlines, seconds)
+
+  # Index of the first group at or after the given number of seconds
+  # into the song. The first event at or after any time always starts
+  # a group. 
+  def group_at(self, seconds):
+    return bisect.bisect_left(self._group_heads, self.event_at(seconds))
+
+  # Messages (raw bytes) that put every channel back into the state
+  # it is in just before event i: controllers (including pedals),
+  # programs and pitch bend. Starts from the nearest snapshot, so at
+  # most _snapshot_interval events are looked at. 
+  def state_at(self, i):
+    i = min(i, len(self.deadlines))
+    first = i // _snapshot_interval * _snapshot_interval
+    state = bytearray(self._snapshots[i // _snapshot_interval])
+    data = self.data
+    offsets = self.offsets
+    for j in range(first, i):
+      if 0xB0 <= data[offsets[j]] < 0xF0:
+        _apply_to_state(state, data[offsets[j]:offsets[j+1]])
+    return _state_messages(state)
+
+  # Return the raw bytes of event i.
+  def event_bytes(self, i):
+    return self.data[self.offsets[i]:self.offsets[i+1]]
+
+  # Return a mido Message for event i.
+  def event_message(self, i):
+    return mido.Message.from_bytes(self.event_bytes(i))
+
+# Append the raw bytes of events [start, end) to batch, dropping
+# status bytes that repeat the previous one (running status).
+def _append_running_status(batch, data, offsets, start, end):
+  running_status = None
+  for i in range(start, end):
+    status = data[offsets[i]]
+    if status < 0xF0:
+      # Channel voice/mode message: the status byte can be omitted if
+      # it repeats the previous one.
+      if status == running_status:
+        batch += data[offsets[i]+1:offsets[i+1]]
+        continue
+      running_status = status
+    elif status < 0xF8:
+      # System exclusive/common messages cancel running status.
+      # (Real-time messages don't affect it.)
+      running_status = None
+    batch += data[offsets[i]:offsets[i+1]]
+
+# Record a controller change, program change or pitch bend in a
+# channel state snapshot. Other messages are ignored. 
+def _apply_to_state(state, message_bytes):
+  kind = message_bytes[0] & 0xF0
+  channel = message_bytes[0] & 0x0F
+  if kind == 0xB0:
+    if message_bytes[1] not in _untracked_controllers:
+      state[channel * 128 + message_bytes[1]] = message_bytes[2]
+  elif kind == 0xC0:
+    state[_program_offset + channel] = message_bytes[1]
+  elif kind == 0xE0:
+    state[_pitch_bend_offset + channel * 2] = message_bytes[1]
+    state[_pitch_bend_offset + channel * 2 + 1] = message_bytes[2]
+
+# Whether the event message_bytes can be left out of a compacted song
+# (see MidiTimeline.compacted). values and playing track what has 
+# been sent so far and are updated for events that are kept. 
+def _is_redundant(message_bytes, values, playing, tolerance):
+  status = message_bytes[0]
+  if status >= 0xF0:
+    if status == 0xF0:
+      # A sysex message (i.e. a GM reset) may reset anything.
+      values.clear()
+    return False
+  kind = status & 0xF0
+  channel = status & 0x0F
+  if kind == 0x90 and message_bytes[2] > 0:
+    note = channel * 128 + message_bytes[1]
+    playing[note] = min(playing[note] + 1, 255)
+    return False
+  if kind == 0x80 or kind == 0x90:
+    note = channel * 128 + message_bytes[1]
+    if playing[note] == 0:
+      return True
+    playing[note] -= 1
+    return False
+
+  if kind == 0xB0:
+    controller = message_bytes[1]
+    if controller == 120 or controller >= 123:
+      # All sound/notes off, and the mode changes that imply it.
+      playing[channel * 128:(channel + 1) * 128] = bytes(128)
+      return False
+    if controller == 121:
+      # Reset all controllers (everything but the program).
+      for key in [key for key in values if key >> 8 & 0x0F == channel and key >> 8 & 0xF0 != 0xC0]:
+        del values[key]
+      return False
+    if controller in _untracked_controllers:
+      return False
+    if controller == 0 or controller == 32:
+      # A bank select makes the next program change count, whatever
+      # program it is. 
+      values.pop((0xC0 | channel) << 8, None)
+    key = status << 8 | controller
+    value = message_bytes[2]
+    allowance = tolerance if controller in _continuous_controllers else 0
+  elif kind == 0xC0:
+    key = status << 8
+    value = message_bytes[1]
+    allowance = 0
+  elif kind == 0xD0:
+    key = status << 8
+    value = message_bytes[1]
+    allowance = tolerance
+  elif kind == 0xE0:
+    key = status << 8
+    value = message_bytes[1] | message_bytes[2] << 7
+    allowance = tolerance * 128
+  else:
+    # Polyphonic aftertouch.
+    return False
+
+  previous = values.get(key)
+  if previous is not None and abs(value - previous) <= allowance:
+    if kind != 0xB0 or controller not in _switch_controllers or (value >= 64) == (previous >= 64):
+      return True
+  values[key] = value
+  return False
+
+# Shift the note number of every note on/off and polyphonic 
+# aftertouch message by semitones, clamped to the MIDI note range.
+# The drum channel (10) is left alone since its notes pick 
+# instruments, not pitches. 
+def _transpose_notes(data, offsets, semitones):
+  table = bytes([min(max(note + semitones, 0), 127) for note in range(128)])
+  for i in range(len(offsets) - 1):
+    status = data[offsets[i]]
+    if 0x80 <= status < 0xB0 and status & 0x0F != 9:
+      data[offsets[i] + 1] = table[data[offsets[i] + 1]]
+
+# The messages that recreate a channel state snapshot. Controllers go
+# first so that bank selects are in place for the program change. 
+def _state_messages(state):
+  messages = []
+  for channel in range(16):
+    for controller in range(128):
+      value = state[channel * 128 + controller]
+      if value != _unset:
+        messages.append(bytes([0xB0 | channel, controller, value]))
+    program = state[_program_offset + channel]
+    if program != _unset:
+      messages.append(bytes([0xC0 | channel, program]))
+    lsb = state[_pitch_bend_offset + channel * 2]
+    if lsb != _unset:
+      messages.append(bytes([0xE0 | channel, lsb, state[_pitch_bend_offset + channel * 2 + 1]]))
+  return messages
+
+# Messages that silence every channel: sustain pedal up, then all 
+# notes off. Sent when pausing or jumping around in a song. 
+def silence_messages():
+  messages = []
+  for channel in range(16):
+    messages.append(bytes([0xB0 | channel, 64, 0]))
+    messages.append(bytes([0xB0 | channel, 123, 0]))
+  return messages
+
+# Messages that silence every channel and put its controllers back to
+# their defaults: Reset All Controllers, then volume and pan, which
+# that leaves alone. Sent before picking a song up again (after a 
+# seek or resume); the song's own state there is restored on top. 
+def reset_messages():
+  messages = silence_messages()
+  for channel in range(16):
+    messages.append(bytes([0xB0 | channel, 121, 0]))
+    messages.append(bytes([0xB0 | channel, 7, _default_volume]))
+    messages.append(bytes([0xB0 | channel, 10, _default_pan]))
+  return messages
+
+# Given a MidiFile, walk its merged tracks once (converting ticks to
+# seconds through the tempo map) and produce a MidiTimeline.
+def compile_midi_file(midi_file, song_name = None):
+  timeline = MidiTimeline(song_name = song_name)
+  now = 0.0
+  # Iterating over a MidiFile yields the merged tracks with delta
+  # times already converted to seconds.
+  for msg in midi_file:
+    now += msg.time
+    if msg.is_meta:
+      if msg.type == "set_tempo" and timeline.tempo is None:
+        timeline.tempo = msg.tempo
+      continue
+    timeline.append(now, msg.bytes())
+  timeline.duration = now
+  return timeline
@@ -0,0 +1,122 @@
+#
+# playback_clock.py
+#
+# The clock songs are played against. The player and its real-time
+# senders read the time, and wait for deadlines, through a clock
+# rather than calling time.monotonic themselves. The real one is
+# MonotonicClock. VirtualClock lets playback run offline at CPU speed
+# instead: once every sender is waiting for a deadline (or has nothing
+# more to send), the time jumps straight to the earliest of them. A
+# whole song (or library) can then be played against recording ports
+# (see benchmarks/benchmark_ports.RecordingPort) in seconds, with
+# every event on every port landing exactly on its deadline.
+#
+# To check what happens when playback is interrupted part of the way
+# through (a stop, seek or replace), a VirtualClock can be held at a
+# given time: playback waits there, in real time, until the test has
+# done what it wants and releases it.
+
+import threading
+import time
+
+# How often (real seconds) a sender waiting on a VirtualClock checks
+# back, i.e. once another sender has run out of events to send, or
+# its own buffer has been flushed.
+_wait_poll_interval = 0.001
+
+class MonotonicClock:
+  """
+  Real time, as time.monotonic.
+  """
+  def now(self):
+    return time.monotonic()
+
+  def register(self, sender):
+    pass
+
+  # Wait on condition (which the caller, sender, holds) until it is
+  # notified, or deadline has passed.
+  def wait_until(self, condition, deadline, sender):
+    remaining = deadline - time.monotonic()
+    if remaining > 0:
+      condition.wait(remaining)
+
+class VirtualClock:
+  """
+  Time that only passes when playback waits for it. Every sender
+  playing against the clock registers with it; the time moves on once
+  all of them are waiting for a deadline or idle, and only as far as
+  the earliest deadline, so no port is made to send late by another.
+  Starts at start seconds. The time never goes backwards.
+  """
+  def __init__(self, start = 0.0):
+    self._now = start
+    # The clock doesn't move past this, if set, until release().
+    self._hold_at = None
+    self._condition = threading.Condition()
+    # Every registered sender, and the deadline each sender that is
+    # waiting in wait_until is waiting for.
+    self._senders = []
+    self._waiting = {}
+
+  def now(self):
+    return self._now
+
+  # Have the clock wait for sender (see RealtimeSender.idle) before
+  # moving on.
+  def register(self, sender):
+    with self._condition:
+      if sender not in self._senders:
+        self._senders.append(sender)
+
+  def wait_until(self, condition, deadline, sender):
+    with self._condition:
+      self._waiting[sender] = deadline
+      self._move_on()
+      waiting = self._now < deadline
+      if waiting:
+        # Waiting for the other senders to catch up, or held. Let go of
+        # the caller's lock meanwhile, so that a stop (or anything else
+        # that needs it) gets through.
+        condition.release()
+        self._condition.wait(_wait_poll_interval)
+      del self._waiting[sender]
+    if waiting:
+      condition.acquire()
+
+  # Move the time on to the earliest deadline being waited for, unless
+  # a sender is still busy. Must be called with _condition held.
+  def _move_on(self):
+    for sender in self._senders:
+      if sender not in self._waiting and not sender.idle():
+        return
+    if len(self._waiting) == 0:
+      return
+    target = min(self._waiting.values())
+    if self._hold_at is not None and self._hold_at < target:
+      target = self._hold_at
+    if target > self._now:
+      self._now = target
+      self._condition.notify_all()
+
+  # Move the clock seconds on, i.e. to let a paused song's time pass.
+  def advance(self, seconds):
+    with self._condition:
+      self._now += seconds
+      self._condition.notify_all()
+
+  # Don't let the clock move past seconds until release() is called.
+  def hold_at(self, seconds):
+    with self._condition:
+      self._hold_at = seconds
+
+  def release(self):
+    with self._condition:
+      self._hold_at = None
+      self._condition.notify_all()
+
+  # Block the caller (in real time) until the clock reaches seconds,
+  # or timeout real seconds pass. Returns True if it did.
+  def wait_for(self, seconds, timeout = None):
+    with self._condition:
+      return self._condition.wait_for(lambda: self._now >= seconds, timeout)
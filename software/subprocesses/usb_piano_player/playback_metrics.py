@@ -0,0 +1,168 @@
+#
+# playback_metrics.py
+#
+# Timing instrumentation for the playback loop: how late each event
+# is sent compared to its deadline, how many events were sent late,
+# send throughput and time-to-first-note for each song. Lateness is
+# kept in a fixed set of histogram buckets, so memory use doesn't
+# grow with the number of events and recording an event is a bisect
+# and a couple of additions. Rendered in the Prometheus text format
+# for the /metrics endpoint.
+#
+# When playing to several ports at once, every port's sender records
+# here, so recording is serialized by a lock.
+
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+
+# Upper bounds (seconds) of the lateness histogram buckets. Anything
+# later than the last bound only lands in +Inf.
+_lateness_buckets = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# Upper bounds (seconds) of the time-to-first-note histogram buckets.
+_first_note_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds (seconds) of the group write time histogram buckets.
+_write_buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01)
+
+# Upper bounds (seconds) of the port skew histogram buckets.
+_skew_buckets = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.05)
+
+# How many recent groups to remember the first write of, for
+# measuring the skew of the other ports' writes of the same group.
+_tracked_port_writes = 1024
+
+# Events sent more than this many seconds after their deadline are
+# counted as late.
+_late_threshold = 0.005
+
+class Histogram:
+  """
+  Fixed-bucket histogram. counts[i] is the number of observations
+  falling in (bounds[i-1], bounds[i]]; the last count is +Inf.
+  """
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.sum = 0.0
+    self.count = 0
+
+  # Record count observations of value.
+  def observe(self, value, count = 1):
+    self.counts[bisect_left(self.bounds, value)] += count
+    self.sum += value * count
+    self.count += count
+
+  # Prometheus exposition lines for this histogram.
+  def render(self, name, help_text):
+    lines = ["# HELP %s %s" % (name, help_text), "# TYPE %s histogram" % name]
+    cumulative = 0
+    for bound, count in zip(self.bounds, self.counts):
+      cumulative += count
+      lines.append('%s_bucket{le="%s"} %d' % (name, repr(bound), cumulative))
+    lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+    lines.append("%s_sum %r" % (name, self.sum))
+    lines.append("%s_count %d" % (name, self.count))
+    return lines
+
+class PlaybackMetrics:
+  def __init__(self, late_threshold = _late_threshold):
+    self.late_threshold = late_threshold
+    self.lateness = Histogram(_lateness_buckets)
+    self.time_to_first_note = Histogram(_first_note_buckets)
+    # How long writing each group of simultaneous events took, i.e.
+    # the skew between the first and last note of a chord.
+    self.group_write = Histogram(_write_buckets)
+    # How much later than the first port each other port wrote the
+    # same group of events, when playing to several ports.
+    self.port_skew = Histogram(_skew_buckets)
+    self.events_sent = 0
+    self.late_events = 0
+    self.songs_started = 0
+    self.songs_completed = 0
+
+    # Most recent song.
+    self.last_song_name = None
+    self.last_time_to_first_note = 0.0
+    self.last_song_events = 0
+    self.last_song_seconds = 0.0
+
+    # Deadline of each recently written group -> when the first port
+    # wrote it.
+    self._port_writes = OrderedDict()
+    self._lock = threading.Lock()
+
+  # Called from the playback loop after every group of simultaneous
+  # events is sent. Kept as small as possible - see Histogram.observe.
+  def record_group(self, lateness, count, write_seconds):
+    with self._lock:
+      self.lateness.observe(lateness, count)
+      self.group_write.observe(write_seconds)
+      self.events_sent += count
+      if lateness > self.late_threshold:
+        self.late_events += count
+
+  def record_first_note(self, song_name, seconds):
+    with self._lock:
+      self.songs_started += 1
+      self.last_song_name = song_name
+      self.last_time_to_first_note = seconds
+      self.time_to_first_note.observe(seconds)
+
+  # Called by each port's sender when a song is played to several
+  # ports. Every port shares the same clock and deadlines, so the
+  # first write of a group is the reference the others are measured
+  # against.
+  def record_port_write(self, deadline, written_at):
+    with self._lock:
+      first_written_at = self._port_writes.get(deadline)
+      if first_written_at is None:
+        self._port_writes[deadline] = written_at
+        if len(self._port_writes) > _tracked_port_writes:
+          self._port_writes.popitem(last = False)
+      else:
+        self.port_skew.observe(abs(written_at - first_written_at))
+
+  # Called when a song finishes or is stopped.
+  def record_song_end(self, events, seconds, completed):
+    self.last_song_events = events
+    self.last_song_seconds = seconds
+    if completed:
+      self.songs_completed += 1
+
+  def last_song_messages_per_second(self):
+    if self.last_song_seconds <= 0:
+      return 0.0
+    return self.last_song_events / self.last_song_seconds
+
+  # The whole set of metrics in the Prometheus text format.
+  def render(self):
+    lines = []
+    lines += self.lateness.render("usb_piano_player_event_lateness_seconds",
+      "How late each MIDI event was sent relative to its deadline.")
+    lines += self.time_to_first_note.render("usb_piano_player_time_to_first_note_seconds",
+      "Time from a song being requested to its first event being sent.")
+    lines += self.group_write.render("usb_piano_player_group_write_seconds",
+      "Time taken to write each group of simultaneous events to the port.")
+    lines += self.port_skew.render("usb_piano_player_port_skew_seconds",
+      "How much later than the first port each other port wrote the same group of events.")
+
+    def single(name, metric_type, help_text, value, labels = ""):
+      lines.append("# HELP %s %s" % (name, help_text))
+      lines.append("# TYPE %s %s" % (name, metric_type))
+      lines.append("%s%s %r" % (name, labels, value))
+
+    single("usb_piano_player_events_sent_total", "counter", "MIDI events sent.", self.events_sent)
+    single("usb_piano_player_late_events_total", "counter",
+      "MIDI events sent more than %r seconds after their deadline." % self.late_threshold, self.late_events)
+    single("usb_piano_player_songs_started_total", "counter", "Songs that sent their first event.", self.songs_started)
+    single("usb_piano_player_songs_completed_total", "counter", "Songs that played to the end.", self.songs_completed)
+    song_label = ""
+    if self.last_song_name is not None:
+      song_label = '{song="%s"}' % str(self.last_song_name).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    single("usb_piano_player_last_time_to_first_note_seconds", "gauge",
+      "Time to first note of the most recent song.", self.last_time_to_first_note, song_label)
+    single("usb_piano_player_last_song_messages_per_second", "gauge",
+      "Average send rate of the most recently finished song.", self.last_song_messages_per_second())
+    return "\n".join(lines) + "\n"
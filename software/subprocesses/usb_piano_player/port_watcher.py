@@ -0,0 +1,108 @@
+#
+# port_watcher.py
+#
+# Keeps the player's output ports connected when the piano is turned
+# off and on again or its USB cable is re-seated. A background thread
+# looks in every _poll_interval seconds; a port that is no longer
+# listed (or that failed a write) is disconnected, which pauses the
+# song that was playing, and is reopened as soon as it is listed
+# again, which carries on with the song from there (see
+# UsbPianoPlayer.disconnect_output and reconnect_output).
+#
+# Listing the ports goes through the MIDI backend and is slow next to
+# everything else here, so the list is cached. It is only listed
+# again when the device directory changes - ALSA adds and removes
+# nodes there whenever a USB MIDI device comes or goes - or while a
+# port is missing. Where there is no device directory to watch, the
+# ports are listed every time.
+#
+# A port that can't be found or opened is only tried again once the
+# list of ports has changed, rather than on every check (and reported
+# missing every time).
+
+import os
+import threading
+
+import mido
+
+# How often (seconds) the ports are checked.
+_poll_interval = 0.25
+
+# Directory whose modification time changes when MIDI devices come
+# and go.
+_device_directory = "/dev/snd"
+
+class PortWatcher:
+  def __init__(self, player, poll_interval = _poll_interval, device_directory = _device_directory):
+    self.player = player
+    self.poll_interval = poll_interval
+    self.device_directory = device_directory
+
+    # Cached result of mido.get_output_names, and the modification
+    # time (ns) of device_directory when it was listed.
+    self._available_ports = None
+    self._device_mtime = None
+    # The list of ports when opening a port last failed, if it did.
+    self._failed_ports = None
+    self._stop_event = threading.Event()
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop_event.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def _run(self):
+    while not self._stop_event.wait(self.poll_interval):
+      try:
+        self.check()
+      except Exception as e:
+        print("[ERROR] PortWatcher ran into an exception while checking ports! Exception: ")
+        print(e)
+
+  # Disconnect ports that have gone away and reconnect those that have
+  # come back.
+  def check(self):
+    player = self.player
+    if player.opening_ports:
+      return
+    # A port that failed a write is as good as gone, even if it's
+    # still listed.
+    for output in player.outputs:
+      if output.connected and output.sender.error is not None:
+        player.disconnect_output(output)
+
+    searching = any(not output.connected for output in player.outputs)
+    available_ports = self.available_ports(refresh = searching)
+    retry = available_ports != self._failed_ports
+    for output in list(player.outputs):
+      port_name = player.find_port_name(output.name, available_ports)
+      if output.connected and port_name is None:
+        player.disconnect_output(output)
+      elif not output.connected and port_name is not None and retry:
+        if not player.reconnect_output(output, port_name):
+          self._failed_ports = available_ports
+
+    if len(player.outputs) == 0 and len(available_ports) > 0 and retry:
+      # Nothing was plugged in at startup (or not the ports asked for).
+      player.open_output_ports()
+      if len(player.outputs) == 0:
+        self._failed_ports = available_ports
+
+  # Names of the available output ports. Only listed again if refresh
+  # is set or the device directory has changed since last time.
+  def available_ports(self, refresh = False):
+    try:
+      device_mtime = os.stat(self.device_directory).st_mtime_ns
+    except OSError:
+      # Nothing to watch.
+      device_mtime = None
+    if refresh or device_mtime is None or device_mtime != self._device_mtime or self._available_ports is None:
+      self._available_ports = mido.get_output_names()
+      self._device_mtime = device_mtime
+    return self._available_ports
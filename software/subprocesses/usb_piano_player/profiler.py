@@ -0,0 +1,200 @@
+#
+# profiler.py
+#
+# Opt-in profiling of the player, for finding out where the time went
+# when a song stutters: parsing, encoding, the port itself or
+# request handling. While profiling is on, the player's entry points
+# (load_song, decode_midi_string, compile_midi_bytes, play_timeline...),
+# the writers of its ports and every web server handler are wrapped
+# in scoped timers. Every song played (each song of the queue
+# included) writes the spans recorded since the song before it to its
+# own file, named after the song, in the Chrome trace event format,
+# which chrome://tracing, Perfetto and speedscope all load.
+#
+# Nothing is wrapped while profiling is off, so the player runs its
+# own methods as if this didn't exist. Turning it on or off swaps the
+# wrappers in or out of the instances (and handler classes) involved.
+
+import json
+import os
+import re
+import threading
+import time
+
+# Set to a directory to profile from startup.
+profile_environment_variable = "USB_PIANO_PLAYER_PROFILE"
+
+# Methods of the player that are timed, other than play_timeline
+# (which every profile is written at the end of). play_midi isn't:
+# it plays the whole queue, so it would span several profiles.
+_player_methods = ["load_song", "decode_midi_string", "compile_midi_bytes", "load_midi_bytes", "load_compiled_midi_file",
+  "load_library_song", "compact_song", "save_midi_file", "stop_playing", "pause", "resume", "seek", "set_tempo"]
+
+# Methods of each port's writer that are timed: building a group's
+# messages ahead of time, and sending them.
+_writer_methods = ["encode_group", "write"]
+
+# Methods of the web server's endpoint classes that are timed.
+_handler_methods = ["get", "post"]
+
+# Spans held until the next profile is written. Any more are dropped
+# (and counted), i.e. while requests come in with nothing playing.
+_max_spans = 500000
+
+# How many of the most recently written profiles are listed.
+_listed_profiles = 50
+
+# Characters not allowed in profile file names.
+_unsafe_characters = re.compile(r"[^A-Za-z0-9._-]+")
+
+class Profiler:
+  """
+  Records how long the player spends in each of its entry points and
+  writes a profile for every song to directory. Handlers of the web
+  server are timed too once it has been handed the server's app (see
+  add_handlers).
+  """
+  def __init__(self, directory, player = None):
+    self.directory = directory
+    self.player = player
+    self.enabled = False
+    # Locations of the profiles written most recently, last first.
+    self.profiles = []
+    self.dropped_spans = 0
+
+    self._spans = []
+    self._thread_names = {}
+    self._handler_classes = []
+    self._lock = threading.Lock()
+
+  # Time the handlers of every endpoint of the flask app as well.
+  def add_handlers(self, app):
+    with self._lock:
+      for view in app.view_functions.values():
+        view_class = getattr(view, "view_class", None)
+        if view_class is not None and view_class not in self._handler_classes:
+          self._handler_classes.append(view_class)
+          if self.enabled:
+            self._wrap_handlers(view_class)
+
+  # Start profiling. Returns self.
+  def enable(self):
+    with self._lock:
+      if not self.enabled:
+        self.enabled = True
+        if self.player is not None:
+          self._wrap_player(self.player)
+        for handler_class in self._handler_classes:
+          self._wrap_handlers(handler_class)
+        print("[INFO] Profiler writing a profile for every song to " + str(self.directory) + ".")
+    return self
+
+  # Stop profiling. A song that is playing still has its profile
+  # written once it ends.
+  def disable(self):
+    with self._lock:
+      if self.enabled:
+        self.enabled = False
+        if self.player is not None:
+          _unwrap(self.player, ["play_timeline"] + _player_methods)
+          for output in self.player.outputs:
+            _unwrap(output.writer, _writer_methods)
+        for handler_class in self._handler_classes:
+          _unwrap(handler_class, _handler_methods)
+        print("[INFO] Profiler stopped.")
+
+  # Return function wrapped in a scoped timer that records a span
+  # called name.
+  def timed(self, function, name, category):
+    def timed_function(*arguments, **keyword_arguments):
+      start = time.perf_counter()
+      try:
+        return function(*arguments, **keyword_arguments)
+      finally:
+        self._record(name, category, start, time.perf_counter())
+    timed_function._profiled = function
+    return timed_function
+
+  def _record(self, name, category, start, end):
+    thread = threading.get_ident()
+    if thread not in self._thread_names:
+      self._thread_names[thread] = threading.current_thread().name
+    if len(self._spans) >= _max_spans:
+      self.dropped_spans += 1
+      return
+    self._spans.append((name, category, thread, start, end))
+
+  def _wrap_player(self, player):
+    for name in _player_methods:
+      _wrap(player, name, self.timed(getattr(player, name), "UsbPianoPlayer." + name, "player"))
+    play_timeline = player.play_timeline
+
+    def profiled_play_timeline(timeline, *arguments, **keyword_arguments):
+      # Writers are replaced when a port is reopened, so pick up the
+      # current ones for every song.
+      for output in player.outputs:
+        for name in _writer_methods:
+          _wrap(output.writer, name, self.timed(getattr(output.writer, name), str(output.name) + "." + name, "port"))
+      start = time.perf_counter()
+      try:
+        return play_timeline(timeline, *arguments, **keyword_arguments)
+      finally:
+        self._record("UsbPianoPlayer.play_timeline", "player", start, time.perf_counter())
+        self.write_profile(timeline.song_name)
+
+    profiled_play_timeline._profiled = play_timeline
+    _wrap(player, "play_timeline", profiled_play_timeline)
+
+  def _wrap_handlers(self, handler_class):
+    for name in _handler_methods:
+      if name in handler_class.__dict__:
+        _wrap(handler_class, name, self.timed(handler_class.__dict__[name], handler_class.__name__ + "." + name, "handler"))
+
+  # Write everything recorded since the last profile to a new profile
+  # for song_name. Returns its location, or None if it couldn't be
+  # written.
+  def write_profile(self, song_name = None):
+    spans, self._spans = self._spans, []
+    if len(spans) == 0:
+      return None
+    origin = min(span[3] for span in spans)
+    threads = set(span[2] for span in spans)
+    events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread, "args": {"name": name}}
+      for thread, name in list(self._thread_names.items()) if thread in threads]
+    for name, category, thread, start, end in spans:
+      events.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread,
+        "ts": round((start - origin) * 1e6, 3), "dur": round((end - start) * 1e6, 3)})
+    profile = {"traceEvents": events, "displayTimeUnit": "ms",
+      "otherData": {"song_name": song_name, "dropped_spans": self.dropped_spans}}
+    self.dropped_spans = 0
+
+    now = time.time()
+    location = os.path.join(self.directory, time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + "%03d-" % (now % 1 * 1000)
+      + _unsafe_characters.sub("_", str(song_name or "song")) + ".json")
+    try:
+      os.makedirs(self.directory, exist_ok = True)
+      with open(location, "w") as profile_file:
+        json.dump(profile, profile_file)
+    except Exception as e:
+      print("[ERROR] Profiler was unable to write profile to location '" + str(location) + "'. Exception: ")
+      print(e)
+      return None
+    print("[DEBUG] Profiler wrote profile of song " + str(song_name) + " to " + location + ".")
+    self.profiles = [location] + self.profiles[:_listed_profiles - 1]
+    return location
+
+# Shadow the method name of target with wrapper (once).
+def _wrap(target, name, wrapper):
+  if not hasattr(getattr(target, name), "_profiled"):
+    setattr(target, name, wrapper)
+
+# Put the methods of target back the way they were.
+def _unwrap(target, names):
+  for name in names:
+    wrapper = target.__dict__.get(name)
+    if wrapper is None or not hasattr(wrapper, "_profiled"):
+      continue
+    if isinstance(target, type):
+      setattr(target, name, wrapper._profiled)
+    else:
+      delattr(target, name)
@@ -0,0 +1,202 @@
+#
+# realtime_sender.py
+#
+# A dedicated thread that does nothing but wait for deadlines and
+# write pre-encoded groups of events to the port. The playback loop
+# (the producer) encodes groups ahead of time and pushes them into a
+# bounded ring buffer; the sender pops them off in order. Keeping
+# message construction, song loading and request handling off this
+# thread - and running it at an elevated scheduling priority where
+# the OS allows - keeps timing tight while uploads are being parsed.
+
+import os
+import sys
+import threading
+
+from playback_clock import MonotonicClock
+
+# Real-time priority requested for the sender thread (SCHED_FIFO,
+# 1-99). Only used if the process is allowed to.
+_realtime_priority = 50
+
+# Niceness to fall back to if real-time scheduling isn't allowed.
+_fallback_niceness = -10
+
+# How often (seconds) the interpreter asks a running thread to give
+# up the GIL. Python's default of 5ms is how late the sender can be
+# woken while another thread is parsing a song, so shorten it.
+_gil_switch_interval = 0.001
+
+class RingBuffer:
+  """
+  Fixed-capacity FIFO of (deadline, payload, count, first_note)
+  tuples. Slots are preallocated, so steady-state playback allocates
+  nothing beyond the payloads themselves.
+  """
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self._slots = [None] * capacity
+    self._head = 0
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def full(self):
+    return self._size == self.capacity
+
+  def push(self, item):
+    self._slots[(self._head + self._size) % self.capacity] = item
+    self._size += 1
+
+  def peek(self):
+    return self._slots[self._head]
+
+  def pop(self):
+    item = self._slots[self._head]
+    self._slots[self._head] = None
+    self._head = (self._head + 1) % self.capacity
+    self._size -= 1
+    return item
+
+  def clear(self):
+    self._slots = [None] * self.capacity
+    self._head = 0
+    self._size = 0
+
+class RealtimeSender:
+  # Deadlines are read off clock (the real one if not given - see
+  # playback_clock.py).
+  def __init__(self, writer, metrics, capacity = 256, clock = None):
+    self.writer = writer
+    self.metrics = metrics
+    self.clock = clock or MonotonicClock()
+    # Set if the writer raised; cleared by flush().
+    self.error = None
+    # Set when the song is also being played to other ports, to record
+    # the skew between them. 
+    self.record_skew = False
+    # Set while the producer may still queue more of the song being
+    # played, so that a VirtualClock waits for it. 
+    self.feeding = False
+
+    self._buffer = RingBuffer(capacity)
+    self._condition = threading.Condition()
+    # True while the sender holds a group it has popped but not yet
+    # finished writing.
+    self._busy = False
+
+    if sys.getswitchinterval() > _gil_switch_interval:
+      sys.setswitchinterval(_gil_switch_interval)
+
+    self.clock.register(self)
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  # True if the sender has nothing to write and nothing more coming.
+  # Read without the lock (see playback_clock.VirtualClock), so _busy
+  # is set before a group is popped and cleared after it is written. 
+  def idle(self):
+    return len(self._buffer) == 0 and not self._busy and not self.feeding
+
+  # Producer side: queue a pre-encoded group to be written at
+  # deadline (on the sender's clock). first_note is (song_name,
+  # requested_at) for the first group of a song, otherwise None.
+  # Blocks while the buffer is full. Returns False (without queueing)
+  # if should_stop is set while waiting.
+  def put(self, deadline, payload, count, first_note, should_stop):
+    with self._condition:
+      while self._buffer.full():
+        if should_stop.is_set():
+          return False
+        self._condition.wait()
+      if should_stop.is_set():
+        return False
+      self._buffer.push((deadline, payload, count, first_note))
+      self._condition.notify_all()
+      return True
+
+  # Block until everything queued so far has been written, or
+  # should_stop is set. Returns True if drained.
+  def wait_until_drained(self, should_stop):
+    with self._condition:
+      while True:
+        # A flush empties the buffer too, so check for a stop first.
+        if should_stop.is_set():
+          return False
+        if len(self._buffer) == 0 and not self._busy:
+          return True
+        self._condition.wait()
+
+  # Drop everything that hasn't been written yet and wake anyone
+  # waiting on the sender (used for stop/skip/replace).
+  def flush(self):
+    with self._condition:
+      self._buffer.clear()
+      self.error = None
+      self._condition.notify_all()
+
+  def _run(self):
+    self._elevate_priority()
+    buffer = self._buffer
+    condition = self._condition
+    record_group = self.metrics.record_group
+    clock = self.clock
+    while True:
+      with condition:
+        # Wait for the next group's deadline. A flush (or new, earlier
+        # group) wakes us up to re-check.
+        while True:
+          if len(buffer) == 0:
+            condition.wait()
+            continue
+          deadline = buffer.peek()[0]
+          if clock.now() >= deadline:
+            break
+          clock.wait_until(condition, deadline, self)
+        self._busy = True
+        deadline, payload, count, first_note = buffer.pop()
+        condition.notify_all()
+
+      try:
+        now = clock.now()
+        # Looked up every time so the writer can be swapped (i.e. when
+        # the port is reopened).
+        self.writer.write(payload)
+        record_group(now - deadline, count, clock.now() - now)
+        if self.record_skew:
+          self.metrics.record_port_write(deadline, now)
+        if first_note is not None:
+          self.metrics.record_first_note(first_note[0], now - first_note[1])
+      except Exception as e:
+        # A port that has gone away fails every write until it is 
+        # reopened, so only report the first. 
+        if self.error is None:
+          print("[ERROR] RealtimeSender ran into an exception while writing! Exception: ")
+          print(e)
+        with condition:
+          buffer.clear()
+          self.error = e
+      finally:
+        with condition:
+          self._busy = False
+          condition.notify_all()
+
+  # Ask for real-time (SCHED_FIFO) scheduling for this thread, falling
+  # back to a lower niceness, falling back to nothing.
+  def _elevate_priority(self):
+    if hasattr(os, "sched_setscheduler") and hasattr(os, "SCHED_FIFO"):
+      try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(_realtime_priority))
+        print("[INFO] RealtimeSender running with SCHED_FIFO priority " + str(_realtime_priority) + ".")
+        return
+      except (OSError, AttributeError):
+        pass
+    if hasattr(os, "setpriority") and hasattr(threading, "get_native_id"):
+      try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), _fallback_niceness)
+        print("[INFO] RealtimeSender running with niceness " + str(_fallback_niceness) + ".")
+        return
+      except (OSError, AttributeError):
+        pass
+    print("[DEBUG] RealtimeSender unable to raise its scheduling priority; running at normal priority.")
@@ -0,0 +1,88 @@
+#
+# song_cache.py
+#
+# Bounded, content-addressed cache of compiled songs. Songs are keyed
+# by the sha256 hex digest of their raw MIDI bytes, so the same song
+# sent twice (under any name) is only decoded and parsed once. When
+# either the entry or the memory limit is exceeded, the least
+# recently used songs are evicted.
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+# Given the raw bytes of a midi file, return the key it is cached
+# under.
+def hash_midi_bytes(midi_bytes):
+  return hashlib.sha256(midi_bytes).hexdigest()
+
+class SongCache:
+  def __init__(self, max_entries = 16, max_bytes = 64 * 1024 * 1024):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.current_bytes = 0
+
+    # song_hash -> (timeline, size in bytes when it was added). A 
+    # timeline grows once it builds its batches (see 
+    # MidiTimeline.nbytes), so the size it was counted as is kept to
+    # be taken off again when it is evicted. 
+    self._songs = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._songs)
+
+  def __contains__(self, song_hash):
+    return song_hash in self._songs
+
+  # Return the cached timeline for song_hash (marking it as most
+  # recently used), or None.
+  def get(self, song_hash):
+    with self._lock:
+      entry = self._songs.get(song_hash)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._songs.move_to_end(song_hash)
+      self.hits += 1
+      return entry[0]
+
+  # Add a compiled timeline to the cache, evicting the least
+  # recently used songs until we're back under both limits. Songs
+  # that are larger than max_bytes on their own are not cached.
+  def put(self, song_hash, timeline):
+    size = timeline.nbytes()
+    with self._lock:
+      if song_hash in self._songs:
+        self._songs.move_to_end(song_hash)
+        return
+      if size > self.max_bytes or self.max_entries <= 0:
+        return
+      self._songs[song_hash] = (timeline, size)
+      self.current_bytes += size
+      while len(self._songs) > self.max_entries or self.current_bytes > self.max_bytes:
+        _, (_, evicted_size) = self._songs.popitem(last = False)
+        self.current_bytes -= evicted_size
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._songs.clear()
+      self.current_bytes = 0
+
+  # Summary for the /status endpoint.
+  def stats(self):
+    with self._lock:
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "entries": len(self._songs),
+        "bytes": self.current_bytes,
+        "max_entries": self.max_entries,
+        "max_bytes": self.max_bytes,
+      }
@@ -0,0 +1,221 @@
+#
+# song_library.py
+#
+# SQLite index of the midi files kept in piano_songs_location, so the
+# library can be listed (and songs started by id) without touching
+# the files themselves. Every file's duration, track count, note
+# count, initial tempo and sha256 are recorded along with its mtime
+# and size; a refresh only parses files whose mtime or size changed
+# since they were last indexed, and drops files that have gone. 
+# Indexing a file also writes its compiled form (see 
+# compiled_song.py), so library songs start without being parsed.
+# Given a compile pool, the files are parsed in worker processes,
+# spread over every core.
+
+import io
+import os
+import sqlite3
+import threading
+
+import mido
+from mido import MidiFile
+from song_cache import hash_midi_bytes
+from midi_timeline import compile_midi_file
+from compiled_song import write_compiled_song
+
+# File extensions that are indexed.
+_midi_extensions = (".mid", ".midi")
+
+# Microseconds per beat assumed until a song sets its tempo (120 bpm).
+_default_tempo = 500000
+
+# Largest page /songs will return.
+_max_page_size = 500
+
+_schema = """
+CREATE TABLE IF NOT EXISTS songs (
+  id INTEGER PRIMARY KEY,
+  path TEXT NOT NULL UNIQUE,
+  name TEXT NOT NULL,
+  mtime_ns INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  hash TEXT,
+  duration REAL,
+  tracks INTEGER,
+  notes INTEGER,
+  tempo REAL,
+  error TEXT
+);
+"""
+
+# Columns returned for every song.
+_song_columns = "id, name, path, duration, tracks, notes, tempo, hash, size"
+
+# Given a parsed MidiFile, return its duration (seconds), track 
+# count, note count and initial tempo (bpm).
+def describe_midi_file(midi_file):
+  duration = 0.0
+  notes = 0
+  tempo = None
+  for msg in midi_file:
+    duration += msg.time
+    if msg.type == "note_on" and msg.velocity > 0:
+      notes += 1
+    elif msg.type == "set_tempo" and tempo is None:
+      tempo = msg.tempo
+  return {
+    "duration": duration,
+    "tracks": len(midi_file.tracks),
+    "notes": notes,
+    "tempo": mido.tempo2bpm(tempo if tempo is not None else _default_tempo),
+  }
+
+# Parse a single file and return its row. Files that can't be parsed
+# are still recorded (with the error) so they aren't parsed again
+# until they change. Runs in a worker process when the library has a
+# compile pool.
+def _index_file(location, path, stat):
+  row = {"path": path, "name": os.path.splitext(os.path.basename(path))[0], "mtime_ns": stat.st_mtime_ns,
+    "size": stat.st_size, "hash": None, "duration": None, "tracks": None, "notes": None, "tempo": None, "error": None}
+  try:
+    with open(location, "rb") as midi_file:
+      midi_bytes = midi_file.read()
+    midi_song = MidiFile(file=io.BytesIO(midi_bytes))
+    row["hash"] = hash_midi_bytes(midi_bytes)
+    row.update(describe_midi_file(midi_song))
+  except Exception as e:
+    print("[WARNING] SongLibrary was unable to index '" + str(location) + "'. Exception: ")
+    print(e)
+    row["error"] = str(e)
+    return row
+
+  try:
+    timeline = compile_midi_file(midi_song, song_name = row["name"])
+    timeline.song_hash = row["hash"]
+    write_compiled_song(timeline, location, stat)
+  except Exception as e:
+    print("[WARNING] SongLibrary was unable to compile '" + str(location) + "'. Exception: ")
+    print(e)
+  return row
+
+class SongLibrary:
+  def __init__(self, songs_location, index_location = None, compile_pool = None):
+    self.songs_location = songs_location
+    # If set, files are parsed in worker processes (see 
+    # compile_pool.py) - on every core when there are several.
+    self.compile_pool = compile_pool
+    if index_location is None:
+      index_location = os.path.join(songs_location, "library.sqlite3")
+    self.index_location = index_location
+    # True while a background refresh is running.
+    self.refreshing = False
+
+    # One connection shared between threads, serialized by _lock.
+    self._connection = sqlite3.connect(index_location, check_same_thread=False)
+    self._connection.row_factory = sqlite3.Row
+    self._lock = threading.Lock()
+    # Only one refresh runs at a time.
+    self._refresh_lock = threading.Lock()
+    with self._lock:
+      self._connection.executescript(_schema)
+      self._connection.commit()
+
+  def __len__(self):
+    with self._lock:
+      return self._connection.execute("SELECT COUNT(*) FROM songs WHERE error IS NULL").fetchone()[0]
+
+  # Bring the index up to date with the files on disk. Files are only
+  # parsed if they are new or their mtime/size changed. Returns counts
+  # of what happened to each file.
+  def refresh(self):
+    with self._refresh_lock:
+      counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0}
+      with self._lock:
+        indexed = {row["path"]: (row["mtime_ns"], row["size"])
+          for row in self._connection.execute("SELECT path, mtime_ns, size FROM songs")}
+
+      pending = []
+      seen = set()
+      for directory, _, file_names in os.walk(self.songs_location):
+        for file_name in sorted(file_names):
+          if not file_name.lower().endswith(_midi_extensions):
+            continue
+          location = os.path.join(directory, file_name)
+          path = os.path.relpath(location, self.songs_location)
+          try:
+            stat = os.stat(location)
+          except OSError:
+            continue
+          seen.add(path)
+          if indexed.get(path) == (stat.st_mtime_ns, stat.st_size):
+            counts["unchanged"] += 1
+            continue
+          pending.append((location, path, stat))
+
+      if self.compile_pool is not None:
+        changes = self.compile_pool.map(_index_file, pending)
+      else:
+        changes = [_index_file(location, path, stat) for location, path, stat in pending]
+      for row in changes:
+        if row["error"] is not None:
+          counts["failed"] += 1
+        else:
+          counts["updated" if row["path"] in indexed else "added"] += 1
+
+      removed = [path for path in indexed if path not in seen]
+      counts["removed"] = len(removed)
+      with self._lock:
+        self._connection.executemany("""
+          INSERT INTO songs (path, name, mtime_ns, size, hash, duration, tracks, notes, tempo, error)
+          VALUES (:path, :name, :mtime_ns, :size, :hash, :duration, :tracks, :notes, :tempo, :error)
+          ON CONFLICT(path) DO UPDATE SET name=excluded.name, mtime_ns=excluded.mtime_ns, size=excluded.size,
+            hash=excluded.hash, duration=excluded.duration, tracks=excluded.tracks, notes=excluded.notes,
+            tempo=excluded.tempo, error=excluded.error
+        """, changes)
+        self._connection.executemany("DELETE FROM songs WHERE path = ?", [(path,) for path in removed])
+        self._connection.commit()
+      print("[INFO] SongLibrary refreshed: " + str(counts))
+      return counts
+
+  # Run refresh() on a background thread, unless one is already
+  # running. Returns True if a refresh was started.
+  def refresh_in_background(self):
+    if self.refreshing:
+      return False
+    self.refreshing = True
+
+    def run():
+      try:
+        self.refresh()
+      except Exception as e:
+        print("[ERROR] SongLibrary ran into an exception while refreshing! Exception: ")
+        print(e)
+      finally:
+        self.refreshing = False
+
+    threading.Thread(target=run, daemon=True).start()
+    return True
+
+  # A page of songs ordered by id, starting after the given id. The
+  # lookup goes straight to the primary key rather than skipping over
+  # earlier rows. Returns the songs and the id to pass as after for
+  # the next page (None if this is the last page).
+  def list_songs(self, after = 0, limit = 50):
+    limit = max(1, min(limit, _max_page_size))
+    with self._lock:
+      rows = self._connection.execute("SELECT " + _song_columns + " FROM songs WHERE error IS NULL AND id > ? ORDER BY id LIMIT ?",
+        (after, limit + 1)).fetchall()
+    songs = [dict(row) for row in rows[:limit]]
+    next_after = songs[-1]["id"] if len(rows) > limit else None
+    return songs, next_after
+
+  # Return the song with the given id, or None.
+  def get_song(self, song_id):
+    with self._lock:
+      row = self._connection.execute("SELECT " + _song_columns + " FROM songs WHERE error IS NULL AND id = ?",
+        (song_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+  # Location on disk of a song returned by list_songs/get_song.
+  def song_location(self, song):
+    return os.path.join(self.songs_location, song["path"])
@@ -0,0 +1,104 @@
+#
+# song_queue.py
+#
+# Playlist of songs waiting to be played after the current one. A
+# background worker decodes and compiles the song at the head of the
+# queue while the current song plays, so that it is ready to start
+# the moment the current song ends.
+
+from collections import deque
+import threading
+
+class QueuedSong:
+  """
+  A song waiting in the queue. load_song_args are passed through to
+  UsbPianoPlayer.load_song when the song is (pre)fetched.
+  """
+  def __init__(self, song_id, song_name, load_song_args):
+    self.song_id = song_id
+    self.song_name = song_name
+    self.load_song_args = load_song_args
+    self.timeline = None
+    self.loaded = False
+    self._lock = threading.Lock()
+
+  # Load the song if nobody has yet, and return its timeline (None if
+  # it failed to load). Safe to call from the prefetch worker and the
+  # playback thread at the same time - only one will do the work.
+  def load(self, load_song):
+    with self._lock:
+      if not self.loaded:
+        try:
+          self.timeline = load_song(**self.load_song_args)
+        except Exception as e:
+          print("[ERROR] SongQueue was unable to load song " + str(self.song_name) + ". Exception: ")
+          print(e)
+        self.loaded = True
+        # The source (i.e. a base64 string) is no longer needed.
+        self.load_song_args = None
+      return self.timeline
+
+  def summary(self):
+    return {
+      "id": self.song_id,
+      "song_name": self.song_name,
+      "ready": self.loaded and self.timeline is not None,
+      "duration": self.timeline.duration if self.timeline is not None else None,
+    }
+
+class SongQueue:
+  def __init__(self, load_song, max_length = 32):
+    self.load_song = load_song
+    self.max_length = max_length
+
+    self._songs = deque()
+    self._next_id = 0
+    self._condition = threading.Condition()
+
+    self._worker = threading.Thread(target=self._prefetch_worker, daemon=True)
+    self._worker.start()
+
+  def __len__(self):
+    return len(self._songs)
+
+  # Add a song to the back of the queue. Returns its entry, or None if
+  # the queue is full.
+  def enqueue(self, song_name = None, **load_song_args):
+    with self._condition:
+      if len(self._songs) >= self.max_length:
+        return None
+      self._next_id += 1
+      song = QueuedSong(self._next_id, song_name, dict(load_song_args, song_name = song_name))
+      self._songs.append(song)
+      self._condition.notify_all()
+      return song
+
+  # Remove and return the song at the front of the queue (or None).
+  # The caller should load() it; if the prefetch worker got there
+  # first this is free.
+  def pop(self):
+    with self._condition:
+      if not self._songs:
+        return None
+      song = self._songs.popleft()
+      self._condition.notify_all()
+      return song
+
+  def clear(self):
+    with self._condition:
+      self._songs.clear()
+      self._condition.notify_all()
+
+  def list(self):
+    with self._condition:
+      return [song.summary() for song in self._songs]
+
+  # Only the head of the queue is prefetched, so a long queue of big
+  # songs doesn't hold all of them compiled in memory at once.
+  def _prefetch_worker(self):
+    while True:
+      with self._condition:
+        while not self._songs or self._songs[0].loaded:
+          self._condition.wait()
+        song = self._songs[0]
+      song.load(self.load_song)
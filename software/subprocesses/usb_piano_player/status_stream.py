@@ -0,0 +1,73 @@
+#
+# status_stream.py
+#
+# Pushes playback state changes to clients instead of having them
+# poll /status. The player publishes an event whenever something
+# happens to a song (started, finished, stopped, paused, error, and
+# compiled once the length of a song that started playing before it
+# was fully compiled is known); each
+# event gets a sequence number and is kept in a short history, so a
+# client that reconnects with the last sequence number it saw picks
+# up where it left off. Clients block in events_after until there is
+# something new, or add a listener to be called back when there is -
+# see the /events (Server-Sent Events) and /statusPoll (long-poll)
+# endpoints.
+
+from collections import deque
+import threading
+import time
+
+# How many past events are kept for clients catching up.
+_history_length = 128
+
+class StatusStream:
+  def __init__(self, history_length = _history_length):
+    self._events = deque(maxlen = history_length)
+    self._sequence = 0
+    self._listeners = []
+    self._condition = threading.Condition()
+
+  # Sequence number of the most recent event (0 if there are none).
+  def last_sequence(self):
+    return self._sequence
+
+  # Record an event and wake up every waiting client. song_name,
+  # elapsed and total (seconds) describe the song it concerns; any
+  # other fields are passed along as they are.
+  def publish(self, event, song_name = None, elapsed = None, total = None, **fields):
+    with self._condition:
+      self._sequence += 1
+      entry = {"sequence": self._sequence, "event": event, "time": time.time(), "song_name": song_name,
+        "elapsed": elapsed, "total": total}
+      entry.update(fields)
+      self._events.append(entry)
+      self._condition.notify_all()
+      listeners = list(self._listeners)
+    for listener in listeners:
+      listener()
+
+  # Call listener (on the publishing thread) whenever an event is
+  # published, until it is removed again.
+  def add_listener(self, listener):
+    with self._condition:
+      self._listeners.append(listener)
+
+  def remove_listener(self, listener):
+    with self._condition:
+      if listener in self._listeners:
+        self._listeners.remove(listener)
+
+  # Return the events published after the given sequence number,
+  # waiting up to timeout seconds (forever if None) for one if there
+  # are none yet. Returns an empty list on timeout.
+  def events_after(self, sequence, timeout = None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self._condition:
+      # A sequence number from before a restart means "from now on". 
+      sequence = min(sequence, self._sequence)
+      while self._sequence <= sequence:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return []
+        self._condition.wait(remaining)
+      return [entry for entry in self._events if entry["sequence"] > sequence]
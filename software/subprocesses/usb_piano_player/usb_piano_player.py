@@ -5,113 +5,900 @@
 # Self-contained, only plays a single song when directed. Expects
 # a song in the form of either a midi file or a base64 encoded
 # string (i.e. one sent over HTTP). Songs provided via base64 
-# encoded string will have temporary files created that are then
-# deleted upon termination of the program. 
+# encoded string are decoded and parsed entirely in memory, and are
+# only written to disk when explicitly asked to persist them. 
+#
+# server.js starts this at boot and may send a song right away, so
+# the control socket is bound before anything slow happens: the web
+# framework is only imported once it is listening, and the MIDI 
+# ports are opened in the background (see /ready). 
 
 import mido
 from mido import MidiFile
+from midi_timeline import MidiTimeline, compile_midi_file, reset_messages, silence_messages
+from midi_stream import compile_midi_bytes_incrementally
+from song_cache import SongCache, hash_midi_bytes
+from song_queue import SongQueue
+from song_library import SongLibrary
+from compiled_song import load_compiled_song
+from compile_pool import CompilePool
+from playback_metrics import PlaybackMetrics
+from status_stream import StatusStream
+from midi_output import PortOutput, make_port_writer, parse_channel_routing
+from realtime_sender import RealtimeSender
+from port_watcher import PortWatcher
+from control_queue import ControlQueue
+from playback_clock import MonotonicClock
+from profiler import Profiler, profile_environment_variable
 import base64
+import functools
+import io
+import json
 import argparse
 import os
+import re
+import socket
 import threading
 import http
-
-from flask import Flask
-from flask_restful import Resource, Api, reqparse
-from gevent.pywsgi import WSGIServer
 import time
 
 # How many seconds to wait for the web server to send the song to
 # play over HTTP before perishing. 
 _recieve_song_timeout = 20
 
+# How many bytes to read at a time from raw song uploads. 
+_upload_chunk_size = 64 * 1024
+
+# How many seconds to wait for a playing song to acknowledge a stop
+# before giving up on it. 
+_stop_timeout = 5
+
+# How often (seconds) an idle /events stream sends a keepalive 
+# comment, and the longest a /statusPoll request may wait. 
+_event_keepalive = 15
+_max_poll_timeout = 60
+
+# How many seconds a song waits for the output ports to be opened
+# when it is requested during startup (or while the piano is 
+# disconnected), and how often (seconds) it checks whether it has 
+# been stopped meanwhile. 
+_ports_ready_timeout = 10
+_ports_ready_poll_interval = 0.05
+
+# The client:port numbers ALSA appends to port names, which may 
+# change when a device is plugged back in. 
+_alsa_port_numbers = re.compile(r"\s+\d+:\d+$")
+
+# Connections the control socket queues up while the server is 
+# still starting. 
+_listen_backlog = 128
+
+# Seconds after startup that the compile pool's workers are started.
+# Until then they would only compete with the rest of startup; a song
+# that needs one sooner starts it. 
+_compile_pool_start_delay = 2
+
 class UsbPianoPlayer:
   # Relative to the location of server.js.
   piano_songs_location = "./subprocesses/usb_piano_player/piano_songs"
 
+  # The primary output port; see outputs. 
   port = None
+  # Writes groups of events to the port - see midi_output.py. 
+  writer = None
+  # Dedicated thread that feeds the writer - see realtime_sender.py.
+  sender = None
   playing = False
-  stop_song = False
 
-  def __init__(self):
-    available_ports = mido.get_output_names()
-    print("[DEBUG] UsbPianoPlayer available ports: " + str(available_ports))
+  # output_port may be a port (or list of ports) to use instead of 
+  # opening any. Otherwise the ports named in output_port_names are
+  # opened, or the default port if none are named. channel_routing 
+  # optionally maps port names to the channels played on them (see 
+  # midi_output.parse_channel_routing). If open_ports_in_background
+  # is set, the ports are opened on another thread so that a slow 
+  # MIDI backend doesn't hold up startup; songs wait for them (see
+  # wait_until_ready). If compact is set, the redundant events of 
+  # every song are dropped before it is played (see 
+  # MidiTimeline.compacted), thinning out controller sweeps by up to
+  # compact_tolerance. Songs are played against clock, or the real 
+  # clock if none is given - see playback_clock.py for playing them 
+  # offline against a virtual one. 
+  def __init__(self, cache_max_entries = 16, cache_max_bytes = 64 * 1024 * 1024, output_port = None, max_queue_length = 32,
+    raw_midi_device = None, sender_buffer_size = 256, song_library = None, output_port_names = None, channel_routing = None,
+    open_ports_in_background = False, compile_pool = None, compact = False, compact_tolerance = 0, clock = None):
+    self.clock = clock or MonotonicClock()
+    # Index of the songs in piano_songs_location, if any - see 
+    # song_library.py. 
+    self.song_library = song_library
+    # Worker processes songs are parsed and compiled in, if any, so 
+    # that they don't hold up the song that is playing - see 
+    # compile_pool.py. Otherwise they are compiled in this process. 
+    self.compile_pool = compile_pool
+    self.compact = compact
+    self.compact_tolerance = compact_tolerance
+    # Compiled songs, keyed by the sha256 of their midi bytes. 
+    self.song_cache = SongCache(max_entries = cache_max_entries, max_bytes = cache_max_bytes)
+    # Songs to play once the current one finishes. 
+    self.song_queue = SongQueue(self.load_song, max_length = max_queue_length)
+    # Timing accuracy of the playback loop, for /metrics. 
+    self.metrics = PlaybackMetrics()
+    # State changes pushed to /events and /statusPoll clients. 
+    self.status = StatusStream()
+    # When the current song was requested (on clock), until its
+    # first note has been sent. 
+    self._song_requested_at = None
+
+    # Set to interrupt the current song. The playback loop waits on
+    # this between events, so a stop takes effect immediately even
+    # in the middle of a long rest. 
+    self.stop_event = threading.Event()
+    # Set whenever no song is playing. 
+    self.idle_event = threading.Event()
+    self.idle_event.set()
+    # Serializes starting/replacing songs. 
+    self._control_lock = threading.Lock()
+    # The thread play_midi was last started on, if any. 
+    self._playback_thread = None
+    # Set by skip_song so that the interrupted song moves on to the
+    # next one in the queue rather than stopping playback. 
+    self._skip_requested = False
+    # (timeline, start_time) of the song being played, if any. 
+    self._now_playing = None
+    # (timeline, position in seconds) of the paused song, if any. 
+    self._paused = None
+    # Set by set_tempo to the (timeline, position) the current song 
+    # should carry on from at its new tempo. 
+    self._retimed = None
+    # The _paused entry of a song that was paused because a port went
+    # away, to carry on with once it is back. 
+    self._interrupted = None
 
-    if len(available_ports) > 0:
-      print("[INFO] UsbPianoPlayer opening default output port.")
-      # Open the (system specific) default port. 
-      self.port = mido.open_output()
+    # Every port songs are played to, each with its own writer and 
+    # sender (see midi_output.PortOutput), all driven off the same 
+    # clock. The first is the primary port: self.port, self.writer and
+    # self.sender refer to it. 
+    self.outputs = []
+    self._sender_buffer_size = sender_buffer_size
+    self._channel_routing = channel_routing or {}
+    self._output_port_names = output_port_names
+    self._raw_midi_device = raw_midi_device
+    # Set while there is at least one output port and all of them are
+    # connected. 
+    self.ports_ready = threading.Event()
+    # True while open_output_ports is running. 
+    self.opening_ports = False
+    if output_port is not None:
+      # Caller-provided port(s) (i.e. null ports for benchmarks). 
+      for port in (output_port if isinstance(output_port, (list, tuple)) else [output_port]):
+        self.add_output(getattr(port, "name", None), port, make_port_writer(port))
+      self._update_ready()
+    elif open_ports_in_background:
+      self.opening_ports = True
+      threading.Thread(target=self.open_output_ports, daemon=True).start()
     else:
-      print("[ERROR] UsbPianoPlayer could not find an output port!")
-
-  # Bread and butter for this class. Given either a location or a 
-  # pair of song_name + base64 string, load the song and play it
-  # over the port to the connected Yamaha. 
-  def play_midi(self, location = None, song_name = None, base_64_string = None):
-    if self.port is None:
-      print("[ERROR] UsbPianoPlayer is unable to play with a closed output port. Cancelling...")
-      return
+      self.open_output_ports()
+
+  # Open the ports named in output_port_names, or the default port if
+  # none were named. 
+  def open_output_ports(self):
+    self.opening_ports = True
+    output_port_names = self._output_port_names
+    raw_midi_device = self._raw_midi_device
+    try:
+      started_at = time.monotonic()
+      available_ports = mido.get_output_names()
+      print("[DEBUG] UsbPianoPlayer available ports: " + str(available_ports))
+
+      if output_port_names:
+        for name in output_port_names:
+          if name not in available_ports:
+            print("[ERROR] UsbPianoPlayer could not find output port '" + str(name) + "'.")
+            continue
+          print("[INFO] UsbPianoPlayer opening output port '" + str(name) + "'.")
+          port = mido.open_output(name)
+          # Only the primary port may be written to as a raw device. 
+          raw_device_location = raw_midi_device if len(self.outputs) == 0 else None
+          self.add_output(name, port, make_port_writer(port, raw_device_location = raw_device_location))
+      elif len(available_ports) > 0:
+        print("[INFO] UsbPianoPlayer opening default output port.")
+        # Open the (system specific) default port. 
+        port = mido.open_output()
+        self.add_output(port.name, port, make_port_writer(port, raw_device_location = raw_midi_device))
+
+      if len(self.outputs) == 0:
+        print("[ERROR] UsbPianoPlayer could not find an output port!")
+      else:
+        print("[INFO] UsbPianoPlayer output ports opened in %.3f seconds." % (time.monotonic() - started_at))
+    except Exception as e:
+      print("[ERROR] UsbPianoPlayer ran into an exception while opening output ports! Exception: ")
+      print(e)
+    finally:
+      self.opening_ports = False
+      self._update_ready()
+
+  # True if the output ports have been opened and are all connected.
+  def ready(self):
+    return self.ports_ready.is_set()
+
+  # Wait up to timeout seconds for the output ports to be opened (or
+  # reconnected), giving up early if the song is stopped. Returns 
+  # ready(). 
+  def wait_until_ready(self, timeout = _ports_ready_timeout):
+    deadline = time.monotonic() + timeout
+    while not self.ports_ready.wait(min(_ports_ready_poll_interval, max(deadline - time.monotonic(), 0))):
+      if self.stop_event.is_set() or time.monotonic() >= deadline:
+        return self.ready()
+    return True
+
+  def _update_ready(self):
+    if len(self.outputs) > 0 and all(output.connected for output in self.outputs):
+      self.ports_ready.set()
+    else:
+      self.ports_ready.clear()
+
+  # Given the name of a port we had open, return the name it goes by
+  # among available_ports, or None if it isn't there. 
+  def find_port_name(self, name, available_ports):
+    if name in available_ports:
+      return name
+    # Plugged back in as a different ALSA client. 
+    base_name = _alsa_port_numbers.sub("", name or "")
+    for available_port in available_ports:
+      if _alsa_port_numbers.sub("", available_port) == base_name:
+        return available_port
+    return None
+
+  # Stop using output, whose port has gone away (or failed a write).
+  # A playing song is paused where it was, to carry on once the port
+  # is back (see reconnect_output). 
+  def disconnect_output(self, output):
+    with self._control_lock:
+      if not output.connected:
+        return
+      output.connected = False
+      self._update_ready()
+      print("[WARNING] UsbPianoPlayer lost output port '" + str(output.name) + "'.")
+      now_playing = self._now_playing
+      if now_playing is None:
+        self.status.publish("disconnected", port = output.name)
+        return
+      timeline, start_time = now_playing
+      position = self._clamp_position(timeline, self.clock.now() - start_time)
+      self.stop_playing()
+      self._paused = (timeline, position)
+      self._interrupted = self._paused
+      self.status.publish("disconnected", timeline.song_name, elapsed = position, total = timeline.known_duration(), port = output.name)
+
+  # Reopen the port of a disconnected output, now listed as port_name,
+  # and silence it in case anything was left sounding. Once every 
+  # port is back, a song interrupted by the disconnect carries on 
+  # from where it was. Returns False if the port couldn't be opened.
+  def reconnect_output(self, output, port_name):
+    with self._control_lock:
+      if output.connected:
+        return True
+      try:
+        port = mido.open_output(port_name)
+      except Exception as e:
+        print("[WARNING] UsbPianoPlayer was unable to reopen output port '" + str(port_name) + "'. Exception: ")
+        print(e)
+        return False
+      try:
+        output.writer.close()
+        if hasattr(output.port, "close"):
+          output.port.close()
+      except Exception as e:
+        print("[DEBUG] UsbPianoPlayer was unable to close the old port: " + str(e))
+      # Only the primary port may be written to as a raw device. 
+      raw_device_location = self._raw_midi_device if output is self.outputs[0] else None
+      output.port = port
+      output.writer = make_port_writer(port, raw_device_location = raw_device_location)
+      output.sender.writer = output.writer
+      output.sender.flush()
+      output.connected = True
+      if output is self.outputs[0]:
+        self.port = port
+        self.writer = output.writer
+      self._send_now(silence_messages(), outputs = [output])
+      print("[INFO] UsbPianoPlayer reconnected output port '" + str(port_name) + "'.")
+      self.status.publish("reconnected", port = output.name)
+      self._update_ready()
+
+      interrupted = self._interrupted
+      if self.ready() and interrupted is not None and self._paused is interrupted:
+        self._interrupted = None
+        self.stop_playing()
+        timeline, position = interrupted
+        self._start_playback_thread({"timeline": timeline, "position": position, "restore_state": True})
+      return True
+
+  # Start playing to another port, with its own real-time sender. 
+  # Events are routed to it as given by channel_routing. 
+  def add_output(self, name, port, writer):
+    sender = RealtimeSender(writer, self.metrics, capacity = self._sender_buffer_size, clock = self.clock)
+    output = PortOutput(name, port, writer, sender, channels = self._channel_routing.get(name))
+    self.outputs.append(output)
+    if len(self.outputs) == 1:
+      self.port = port
+      self.writer = writer
+      self.sender = sender
+    else:
+      for each_output in self.outputs:
+        each_output.sender.record_skew = True
+    return output
 
+  # Bread and butter for this class. Given either a location, a 
+  # pair of song_name + base64 string, the raw bytes of a midi file,
+  # the hash of a song that is already cached, or the id of a song in
+  # the library, load the song and
+  # play it over the port to the connected Yamaha. If persist_song is
+  # True, decoded songs are also saved into piano_songs_location.
+  # Afterwards, carries on with any songs in the queue. If no song is
+  # given, starts with the first song in the queue. An already 
+  # compiled timeline may be given instead, along with the position
+  # (in seconds) to start playing it from, and restore_state set if 
+  # it is being picked up again (see play_timeline). tempo_factor and
+  # transpose are applied to loaded songs as described in load_song. 
+  def play_midi(self, location = None, song_name = None, base_64_string = None, persist_song = False, song_hash = None, midi_bytes = None,
+    timeline = None, position = 0.0, tempo_factor = 1.0, transpose = 0, song_id = None, restore_state = False):
+    if self._song_requested_at is None:
+      self._song_requested_at = self.clock.now()
+    self.idle_event.clear()
     self.playing = True
-    midi_song = None
-    created_song_location = None
-    if location is not None:
-      midi_song = self.load_midi_file(location = location)
-    elif song_name is not None and base_64_string is not None:
-      midi_song, created_song_location = self.decode_midi_string(base_64_string=base_64_string, song_name = song_name)
-    
-    if midi_song is not None:
+    try:
+      if not self.wait_until_ready():
+        if not self.stop_event.is_set():
+          print("[ERROR] UsbPianoPlayer is unable to play with a closed output port. Cancelling...")
+          self.status.publish("error", song_name if timeline is None else timeline.song_name,
+            message = "No output port is open.")
+        return
+
+      if timeline is None:
+        if location is None and base_64_string is None and song_hash is None and midi_bytes is None and song_id is None:
+          timeline = self.next_queued_song()
+        else:
+          # Channel routing filters the whole song, so a routed song 
+          # can't start before all of it has been compiled. 
+          timeline = self.load_song(location = location, song_name = song_name, base_64_string = base_64_string,
+            persist_song = persist_song, song_hash = song_hash, midi_bytes = midi_bytes, tempo_factor = tempo_factor,
+            transpose = transpose, song_id = song_id, stream = all(output.channels is None for output in self.outputs))
+          if timeline is None:
+            self.status.publish("error", song_name, message = "Song could not be loaded.")
+          elif self.stop_event.is_set() and self._skip_requested is not True:
+            # Stopped (or replaced) while the song was loading. 
+            return
+
       try:
-        # Play it. 
-        print("[INFO] UsbPianoPlayer Now Playing!")
-        for msg in midi_song.play():
-          if self.stop_song is True:
-            break
-          self.port.send(msg)
-        print("[INFO] UsbPianoPlayer song complete!")
-        self.stop_song = False
+        self.play_timelines(timeline, position = position, restore_state = restore_state)
       except Exception as e:
         print("[ERROR] UsbPianoPlayer ran into an exception while playing!")
-
-    # Once we're done, if we decoded a string, delete the file we
-    # created.
-    if created_song_location is not None:
-      self.delete_midi_file(created_song_location)
-    self.playing = False
+        self.status.publish("error", message = str(e))
+    finally:
+      self._flush_senders()
+      self._song_requested_at = None
+      self._now_playing = None
+      self.stop_event.clear()
+      self._skip_requested = False
+      self.playing = False
+      self.idle_event.set()
     print("[INFO] UsbPianoPlayer Complete. Closing.")
 
-  # Given a file location, load a file. 
-  def load_midi_file(self, location):
+  # Play timeline, then each song in the queue in turn until the queue
+  # is empty or we're stopped. Each queued song starts exactly when
+  # the previous one ends if it was prefetched in time. The first
+  # song starts from position seconds in, with its state restored if
+  # restore_state is set (see play_timeline). 
+  def play_timelines(self, timeline, position = 0.0, restore_state = False):
+    start_time = None
+    while True:
+      if timeline is not None:
+        start_time = self.play_timeline(timeline, start_time = start_time, position = position, restore_state = restore_state)
+        position = 0.0
+        restore_state = False
+        retimed = self._retimed
+        self._retimed = None
+        if retimed is not None:
+          # Tempo changed; carry on with the rescaled song from the same
+          # point. (If the song finished first, just move on.) 
+          self.stop_event.clear()
+          if start_time is None:
+            timeline, position = retimed
+            continue
+        elif start_time is None:
+          if self._skip_requested is not True:
+            return
+          # Skipped; start the next song right away. 
+          self._skip_requested = False
+          self.stop_event.clear()
+
+      if self.stop_event.is_set():
+        return
+      timeline = self.next_queued_song()
+      if timeline is None:
+        if len(self.song_queue) == 0:
+          return
+        # Song failed to load - move on to the one after. 
+        self.status.publish("error", message = "Queued song could not be loaded.")
+        start_time = None
+        continue
+      if start_time is not None and start_time < self.clock.now():
+        # The song wasn't ready in time. Start it now rather than 
+        # rushing through the events we missed. 
+        start_time = None
+
+  # Pop the next song off the queue and return its timeline, loading
+  # it now if the prefetch worker hasn't already. Returns None if the
+  # queue is empty or the song couldn't be loaded. 
+  def next_queued_song(self):
+    queued_song = self.song_queue.pop()
+    if queued_song is None:
+      return None
+    return queued_song.load(self.load_song)
+
+  # Given any of the song sources accepted by play_midi, return the
+  # compiled timeline for the song (or None if it couldn't be 
+  # loaded). The song is played tempo_factor times as fast as written
+  # and transposed by transpose semitones. If stream is set, a song 
+  # that has to be compiled is returned as soon as its start has been
+  # (see midi_stream.py), with the rest following in the background.
+  def load_song(self, location = None, song_name = None, base_64_string = None, persist_song = False, song_hash = None, midi_bytes = None,
+    tempo_factor = 1.0, transpose = 0, song_id = None, stream = False):
+    # Transforming or compacting a song needs all of it. 
+    stream = stream and tempo_factor == 1.0 and transpose == 0 and not self.compact
+    timeline = None
+    if location is not None:
+      timeline = self.load_compiled_midi_file(location, song_name = song_name)
+    elif song_name is not None and base_64_string is not None:
+      timeline = self.decode_midi_string(base_64_string=base_64_string, song_name = song_name, persist_song = persist_song,
+        stream = stream)
+    elif midi_bytes is not None:
+      if persist_song is True and song_name is not None:
+        self.save_midi_file(midi_bytes, song_name)
+      timeline = self.compile_midi_bytes(midi_bytes, song_name = song_name, stream = stream)
+    elif song_hash is not None:
+      timeline = self.song_cache.get(song_hash)
+      if timeline is None:
+        print("[ERROR] UsbPianoPlayer does not have song " + str(song_hash) + " cached.")
+      else:
+        timeline = timeline.renamed(song_name)
+    elif song_id is not None:
+      timeline = self.load_library_song(song_id, song_name = song_name)
+    if timeline is not None:
+      timeline = self.compact_song(timeline)
+    if timeline is not None and (tempo_factor != 1.0 or transpose != 0):
+      # Cached timelines are shared, so this makes a copy. 
+      timeline = timeline.transformed(tempo_factor, transpose)
+    return timeline
+
+  # Play a compiled MidiTimeline. Every event is sent against its
+  # absolute deadline from the start of the song (rather than
+  # relative to the previous message) so that timing error does not
+  # accumulate over long pieces. Events sharing a deadline are 
+  # encoded together as one group and handed to the real-time sender
+  # thread, which writes them at their deadline; this thread only
+  # stays ahead of it. Returns early if stop_event is set, including
+  # while waiting for the sender. 
+  # 
+  # The song starts at start_time (on clock), or now if not
+  # given. If position is given, playback picks up that many seconds
+  # into the song, skipping the events before it. If restore_state is
+  # set, the song is being picked up again (after a seek or resume),
+  # so the piano is silenced and reset, and the channel state (pedals,
+  # programs, ...) at position restored, before anything else is 
+  # played - even at the very start of the song. Returns the time at
+  # which the song ends, or None if it was stopped. 
+  #
+  # When playing to several ports, every port but the primary one is
+  # fed from its own thread, so a slow port can't hold up the others.
+  # All of them share start_time, so they stay in step. 
+  def play_timeline(self, timeline, start_time = None, position = 0.0, restore_state = False):
+    print("[INFO] UsbPianoPlayer Now Playing!")
+    if start_time is None:
+      start_time = self.clock.now()
+    if position > 0:
+      start_time -= position
+    first_note = None
+    if self._song_requested_at is not None:
+      first_note = (timeline.song_name, self._song_requested_at)
+      self._song_requested_at = None
+    events_before = self.metrics.events_sent
+    self._now_playing = (timeline, start_time)
+    self.status.publish("started", timeline.song_name, elapsed = position, total = timeline.known_duration())
+    # Every port has more of the song coming until its producer is done
+    # with it. 
+    for output in self.outputs:
+      output.sender.feeding = True
+    try:
+      feeders = []
+      for output in self.outputs[1:]:
+        feeder = threading.Thread(target=self.feed_output, args=(output, timeline, start_time, position, restore_state), daemon=True)
+        feeder.start()
+        feeders.append(feeder)
+      completed = self.feed_output(self.outputs[0], timeline, start_time, position, restore_state, first_note = first_note)
+      for feeder in feeders:
+        feeder.join()
+    finally:
+      self._now_playing = None
+    if self.sender.error is not None:
+      raise self.sender.error
+    self.metrics.record_song_end(self.metrics.events_sent - events_before, self.clock.now() - start_time, completed)
+    if not completed:
+      self.status.publish("stopped", timeline.song_name, elapsed = self._clamp_position(timeline, self.clock.now() - start_time),
+        total = timeline.known_duration())
+      return None
+    self.status.publish("finished", timeline.song_name, elapsed = timeline.duration, total = timeline.duration)
+    print("[INFO] UsbPianoPlayer song complete!")
+    return start_time + timeline.duration
+
+  # The producer half of play_timeline for a single port: encode the
+  # (routed) song a group at a time and queue it on the port's sender,
+  # then wait for the sender to play it out. first_note is passed on
+  # with the first group (see RealtimeSender.put). Returns True if 
+  # the song played to the end, or False if stop_event was set. 
+  def feed_output(self, output, timeline, start_time, position = 0.0, restore_state = False, first_note = None):
+    timeline = output.route(timeline)
+    deadlines = timeline.deadlines
+    stop_event = self.stop_event
+    encode_group = output.writer.encode_group
+    put = output.sender.put
+    try:
+      first_group = 0
+      if position > 0:
+        first_group = timeline.group_at(position)
+      if restore_state:
+        restore = self._control_group(reset_messages() + timeline.state_at(timeline.event_at(position)))
+        if put(start_time + position, encode_group(restore, 0, 0, len(restore)), len(restore), first_note, stop_event):
+          first_note = None
+      # A song that is still being compiled (see midi_stream.py) hands
+      # out its groups as they are finished. 
+      for g, start, end in timeline.groups(first_group):
+        if not put(start_time + deadlines[start], encode_group(timeline, g, start, end), end - start, first_note, stop_event):
+          return False
+        first_note = None
+    finally:
+      output.sender.feeding = False
+    # Everything is queued; wait for the sender to play it out.
+    return output.sender.wait_until_drained(stop_event)
+
+  # Drop whatever the senders have queued and wake up the playback
+  # loop if it's waiting on them. 
+  def _flush_senders(self):
+    for output in self.outputs:
+      output.sender.flush()
+
+  # Ask the current song (if any) to stop and block until it has. A
+  # paused song is forgotten. Returns True if the player is idle 
+  # afterwards. 
+  def stop_playing(self, timeout = _stop_timeout):
+    self._paused = None
+    if self.idle_event.is_set():
+      return True
+    self.stop_event.set()
+    self._flush_senders()
+    if not self.idle_event.wait(timeout):
+      print("[WARNING] UsbPianoPlayer song did not stop within " + str(timeout) + " seconds.")
+      return False
+    return True
+
+  # Skip to the next song in the queue. If the queue is empty, this
+  # just stops the current song. 
+  def skip_song(self):
+    if self.idle_event.is_set():
+      return
+    self._skip_requested = True
+    self.stop_event.set()
+    self._flush_senders()
+
+  # Add a song to the queue (arguments as for load_song). If nothing
+  # is playing, start playing the queue. Returns the queue entry, or
+  # None if the queue is full. 
+  def enqueue_song(self, **load_song_args):
+    queued_song = self.song_queue.enqueue(**load_song_args)
+    if queued_song is not None and self.idle_event.is_set() and self._paused is None:
+      with self._control_lock:
+        if self.idle_event.is_set() and self._paused is None:
+          self._start_playback_thread({})
+    return queued_song
+
+  # Stop whatever is playing and start playing a new song on a 
+  # background thread. Arguments are passed through to play_midi. 
+  def replace_song(self, **play_midi_args):
+    with self._control_lock:
+      self.stop_playing()
+      return self._start_playback_thread(play_midi_args)
+
+  # Stop the current song, remembering where it was so that it can be
+  # resumed. Returns False if nothing is playing. 
+  def pause(self):
+    with self._control_lock:
+      now_playing = self._now_playing
+      if now_playing is None:
+        return False
+      timeline, start_time = now_playing
+      position = self._clamp_position(timeline, self.clock.now() - start_time)
+      self.stop_playing()
+      self._paused = (timeline, position)
+      # Don't leave notes ringing while we're paused. 
+      self._send_now(silence_messages())
+      self.status.publish("paused", timeline.song_name, elapsed = position, total = timeline.known_duration())
+      print("[INFO] UsbPianoPlayer paused " + str(timeline.song_name) + " at " + str(round(position, 3)) + " seconds.")
+      return True
+
+  # Carry on playing the paused song (and then the queue) from where
+  # it was paused. Returns False if nothing is paused. 
+  def resume(self):
+    with self._control_lock:
+      paused = self._paused
+      if paused is None:
+        return False
+      self.stop_playing()
+      timeline, position = paused
+      self._start_playback_thread({"timeline": timeline, "position": position, "restore_state": True})
+      return True
+
+  # Jump to the given number of seconds into the current song. If the
+  # song is paused, it stays paused and resumes from there. Returns
+  # False if there is no current song. 
+  def seek(self, seconds):
+    with self._control_lock:
+      if self._paused is not None:
+        timeline = self._paused[0]
+        self._paused = (timeline, self._clamp_position(timeline, seconds))
+        return True
+      now_playing = self._now_playing
+      if now_playing is None:
+        return False
+      timeline = now_playing[0]
+      self.stop_playing()
+      self._start_playback_thread({"timeline": timeline, "position": self._clamp_position(timeline, seconds), "restore_state": True})
+      return True
+
+  # Change the tempo of the current (playing or paused) song to 
+  # tempo_factor times that of the source song. The remaining events
+  # are rescaled from the compiled song - nothing is parsed again -
+  # and a playing song carries on without a gap. Returns False if 
+  # there is no current song. 
+  def set_tempo(self, tempo_factor):
+    with self._control_lock:
+      if self._paused is not None:
+        timeline, position = self._paused
+        self._paused = (timeline.transformed(tempo_factor, timeline.transpose), position * timeline.tempo_factor / tempo_factor)
+        return True
+      now_playing = self._now_playing
+      if now_playing is None:
+        return False
+      timeline, start_time = now_playing
+      retimed_timeline = timeline.transformed(tempo_factor, timeline.transpose)
+      # Everything due before the flush has been sent; everything after
+      # it is dropped and requeued at the new tempo. 
+      self.stop_event.set()
+      self._flush_senders()
+      position = self._clamp_position(timeline, self.clock.now() - start_time)
+      self._retimed = (retimed_timeline, position * timeline.tempo_factor / tempo_factor)
+      return True
+
+  # Name, position and duration (seconds) of the current song, or None
+  # if there isn't one. The duration is None while the song is still
+  # being compiled. compaction holds its message counts before and 
+  # after compacting, if it was. 
+  def playback_position(self):
+    paused = self._paused
+    if paused is not None:
+      timeline, position = paused
+    else:
+      now_playing = self._now_playing
+      if now_playing is None:
+        return None
+      timeline, start_time = now_playing
+      position = self._clamp_position(timeline, self.clock.now() - start_time)
+    compaction = None
+    if timeline.compacted_from is not None:
+      compaction = {"before": timeline.compacted_from, "after": len(timeline)}
+    return {"song_name": timeline.song_name, "position": position, "duration": timeline.known_duration(),
+      "tempo_factor": timeline.tempo_factor, "transpose": timeline.transpose, "compaction": compaction}
+
+  # seconds, kept within the song - or just above 0 if its length isn't
+  # known yet. 
+  def _clamp_position(self, timeline, seconds):
+    duration = timeline.known_duration()
+    if duration is None:
+      return max(seconds, 0.0)
+    return min(max(seconds, 0.0), duration)
+
+  # Wrap raw messages in a single-group timeline so they can go 
+  # through the writer like any other group. 
+  def _control_group(self, messages):
+    group = MidiTimeline()
+    for message_bytes in messages:
+      group.append(0.0, message_bytes)
+    return group
+
+  # Have every connected port (or just those in outputs) write raw 
+  # messages right away. Must be called while idle. 
+  def _send_now(self, messages, outputs = None):
+    group = self._control_group(messages)
+    now = self.clock.now()
+    for output in (outputs if outputs is not None else self.outputs):
+      if output.connected:
+        output.sender.put(now, output.writer.encode_group(group, 0, 0, len(group)), len(group), None, self.stop_event)
+
+  # Must be called with _control_lock held, after stopping the current
+  # song. 
+  def _start_playback_thread(self, play_midi_args):
+    # A stop can time out (i.e. while the song is still being parsed),
+    # so wait for the last song's thread to finish, however long it 
+    # takes: two songs must never play at once, and the old one would
+    # clear the new one's state as it exits. 
+    previous_thread = self._playback_thread
+    if previous_thread is not None and previous_thread is not threading.current_thread():
+      previous_thread.join()
+    # Mark ourselves busy before the thread starts so that a 
+    # concurrent replace or stop sees this song. 
+    self._song_requested_at = self.clock.now()
+    self.stop_event.clear()
+    self.idle_event.clear()
+    self.playing = True
+    if "timeline" in play_midi_args:
+      # Resuming or seeking: the song is already known, so it can be
+      # paused or sought again before the thread gets going. 
+      self._now_playing = (play_midi_args["timeline"], self.clock.now() - play_midi_args.get("position", 0.0))
+    thread = threading.Thread(target=self.play_midi, kwargs=play_midi_args, daemon=True)
+    self._playback_thread = thread
+    thread.start()
+    return thread
+
+  # Given the id of a song in the library, return its compiled 
+  # timeline, straight from the cache if the song has been played
+  # recently. Returns None if there is no such song or it couldn't be
+  # loaded. 
+  def load_library_song(self, song_id, song_name = None):
+    song = self.song_library.get_song(song_id) if self.song_library is not None else None
+    if song is None:
+      print("[ERROR] UsbPianoPlayer does not have song " + str(song_id) + " in its library.")
+      return None
+    if song_name is None:
+      song_name = song["name"]
+    if song["hash"] in self.song_cache:
+      timeline = self.song_cache.get(song["hash"])
+      if timeline is not None:
+        return timeline.renamed(song_name)
+
+    timeline = self.load_compiled_midi_file(self.song_library.song_location(song), song_name = song_name)
+    if timeline is not None:
+      timeline = self.compact_song(timeline)
+      self.song_cache.put(timeline.song_hash, timeline)
+    return timeline
+
+  # Given a file location, return the compiled song. The compiled 
+  # form kept next to the file (see compiled_song.py) is mapped 
+  # straight into memory if it is up to date, otherwise the file is 
+  # parsed and the compiled form regenerated. Returns None if the song
+  # could not be loaded. 
+  def load_compiled_midi_file(self, location, song_name = None):
     print("[DEBUG] UsbPianoPlayer loading song located: " + str(location) + ".")
-    midi_song = None
     try:
-      midi_song = MidiFile(location)
+      if self.compile_pool is not None:
+        return self.compile_pool.load_file(location, song_name = song_name)
+      return load_compiled_song(location, song_name = song_name)
     except Exception as e:
       print("[ERROR] UsbPianoPlayer was unable to load song from location '" + str(location) + "'. Exception: ")
       print(e)
-    return midi_song
+      return None
 
-  # Given a file location, delete the file. 
-  def delete_midi_file(self, created_song_location):
-    print("[DEBUG] UsbPianoPlayer deleting song located: " + str(created_song_location) + ".")
+  # Given the raw bytes of a midi file, parse them without touching
+  # the disk. 
+  def load_midi_bytes(self, midi_bytes, song_name = None):
+    print("[DEBUG] UsbPianoPlayer loading song from memory: " + str(song_name) + ".")
+    midi_song = None
     try:
-      os.remove(created_song_location)
+      midi_song = MidiFile(file=io.BytesIO(midi_bytes))
     except Exception as e:
-      print("[ERROR] UsbPianoPlayer was unable to delete song from location '" + str(created_song_location) + "'. Exception: ")
+      print("[ERROR] UsbPianoPlayer was unable to load song '" + str(song_name) + "' from memory. Exception: ")
       print(e)
+    return midi_song
 
-  # Given a base 64 encoded string, decode it and create a midi
-  # file. Then load it. 
-  def decode_midi_string(self, base_64_string, song_name):
+  # Given the raw bytes of a midi file, write them to 
+  # piano_songs_location. Returns the location of the new file. 
+  def save_midi_file(self, midi_bytes, song_name):
     new_file_location = self.piano_songs_location + "/" + song_name + ".mid"
-    print("[DEBUG] UsbPianoPlayer Writing base 64 string and song name to file: " + new_file_location)
-    decoded_midi_file = base64.b64decode(base_64_string)
-    new_song_file = open(new_file_location, "wb")
-    new_song_file.write(decoded_midi_file)
-    new_song_file.close()
+    print("[DEBUG] UsbPianoPlayer Writing song to file: " + new_file_location)
+    try:
+      with open(new_file_location, "wb") as new_song_file:
+        new_song_file.write(midi_bytes)
+    except Exception as e:
+      print("[ERROR] UsbPianoPlayer was unable to save song to location '" + str(new_file_location) + "'. Exception: ")
+      print(e)
+      return None
+    if self.song_library is not None:
+      # Pick the new song up in the index. 
+      self.song_library.refresh_in_background()
+    return new_file_location
+
+  # Given the raw bytes of a midi file, return its compiled
+  # timeline. Songs we have seen before are pulled from the cache
+  # instead of being parsed again. Returns None if the song could
+  # not be parsed. If stream is set, the song is compiled 
+  # incrementally (see load_song). 
+  def compile_midi_bytes(self, midi_bytes, song_name = None, stream = False):
+    song_hash = hash_midi_bytes(midi_bytes)
+    timeline = self.song_cache.get(song_hash)
+    if timeline is not None:
+      print("[DEBUG] UsbPianoPlayer found song " + str(song_name) + " in cache: " + song_hash)
+      return timeline.renamed(song_name)
+
+    if stream:
+      compile_incrementally = compile_midi_bytes_incrementally
+      if self.compile_pool is not None:
+        compile_incrementally = self.compile_pool.stream_bytes
+      timeline = compile_incrementally(midi_bytes, song_name = song_name, song_hash = song_hash,
+        on_complete = self._song_compiled)
+      if timeline is not None:
+        return timeline
+
+    if self.compile_pool is not None:
+      print("[DEBUG] UsbPianoPlayer loading song from memory: " + str(song_name) + ".")
+      try:
+        timeline = self.compile_pool.compile_bytes(midi_bytes, song_name = song_name, song_hash = song_hash)
+      except Exception as e:
+        print("[ERROR] UsbPianoPlayer was unable to load song '" + str(song_name) + "' from memory. Exception: ")
+        print(e)
+        return None
+    else:
+      midi_song = self.load_midi_bytes(midi_bytes, song_name = song_name)
+      if midi_song is None:
+        return None
+      timeline = compile_midi_file(midi_song, song_name = song_name)
+      timeline.song_hash = song_hash
+    timeline = self.compact_song(timeline)
+    self.song_cache.put(song_hash, timeline)
+    return timeline
+
+  # Called once a song compiled incrementally is complete. If it is
+  # the current song, it started out with no known length, so let
+  # clients know what it is.
+  def _song_compiled(self, timeline):
+    self.song_cache.put(timeline.song_hash, timeline)
+    now_playing = self._now_playing
+    paused = self._paused
+    if (now_playing is not None and now_playing[0] is timeline) or (paused is not None and paused[0] is timeline):
+      self.status.publish("compiled", timeline.song_name, total = timeline.duration)
+
+  # If the player compacts songs, return a copy of timeline without
+  # its redundant events, reporting how many there were. Songs that 
+  # are already compacted (i.e. from the cache) are returned as they
+  # are. 
+  def compact_song(self, timeline):
+    if not self.compact or timeline.compacted_from is not None:
+      return timeline
+    compacted = timeline.compacted(self.compact_tolerance)
+    print("[INFO] UsbPianoPlayer compacted song " + str(timeline.song_name) + " from " + str(len(timeline)) + " to "
+      + str(len(compacted)) + " messages.")
+    return compacted
+
+  # Given a base 64 encoded string, decode it and return the compiled
+  # song, parsed from memory. The song is only written to disk if 
+  # persist_song is True. Returns None if the string is not valid
+  # base 64 or the song could not be parsed. 
+  def decode_midi_string(self, base_64_string, song_name, persist_song = False, stream = False):
+    print("[DEBUG] UsbPianoPlayer decoding base 64 string for song: " + str(song_name))
+    try:
+      decoded_midi_file = base64.b64decode(base_64_string)
+    except ValueError as e:
+      # binascii.Error, i.e. bad padding. 
+      print("[ERROR] UsbPianoPlayer was unable to decode base 64 string for song '" + str(song_name) + "'. Exception: ")
+      print(e)
+      return None
+    if persist_song is True:
+      self.save_midi_file(decoded_midi_file, song_name)
+
+    return self.compile_midi_bytes(decoded_midi_file, song_name = song_name, stream = stream)
 
-    # Now load the file. 
-    return self.load_midi_file(location = new_file_location), new_file_location
+# Bind the control socket on application_port. This is done before
+# anything slow is imported or opened, so that requests sent while
+# the rest of startup completes wait in the backlog instead of being
+# refused. 
+def bind_control_socket(application_port):
+  return socket.create_server(("localhost", int(application_port)), backlog = _listen_backlog)
 
 class PianoPlayerWebServer:
   """
@@ -125,8 +912,24 @@ class PianoPlayerWebServer:
 
   1. Stop the song - just terminate the web server here. 
   2. Replace the song - start playing something else. 
+
+  Both (and pausing, resuming, seeking and changing tempo) are run
+  on a ControlQueue, at most max_pending_controls of them waiting at
+  a time. 
+
+  Given a Profiler, its handlers are timed along with the player 
+  whenever profiling is turned on (see /profile). 
   """
-  def __init__(self, application_port, player):
+  def __init__(self, application_port, player, max_upload_bytes = 32 * 1024 * 1024, listener = None, max_pending_controls = 16,
+    profiler = None):
+    # Imported here rather than up top as they're slow to import, and
+    # startup binds the control socket first (see listener). 
+    from flask import Flask, request, Response
+    from flask_restful import Resource, Api, reqparse, inputs
+    import gevent
+    from gevent.event import AsyncResult
+    from gevent.pywsgi import WSGIServer
+
     # Define the application.
     app = Flask(__name__)
 
@@ -137,66 +940,527 @@ class PianoPlayerWebServer:
     # Define the API, which we will add our endpoints onto. 
     api = Api(app)
 
-    # Starting new songs (and replacing existing songs)
-    def post_start_song(self, player=player):
+    # Control commands run one at a time on the control queue's thread
+    # (see control_queue.py) rather than on the server's. 
+    control_queue = ControlQueue(max_pending = max_pending_controls)
+    self.control_queue = control_queue
+
+    # Stop whatever is currently playing, then kick off a new song in
+    # the background. Arguments are passed through to play_midi. Any
+    # command still waiting to run is dropped, so a burst of starts 
+    # only plays (and decodes) the last song. 
+    def start_song(player, **play_midi_args):
+      def replace():
+        player.stop_playing()
+        # A newer start came in while the current song was stopping;
+        # leave it to that one. 
+        if not control_queue.replacement_pending():
+          player.replace_song(**play_midi_args)
+      control_queue.submit(replace, replaces_pending = True)
+
+    # Block the calling request, but not the server, until the wake-up
+    # function handed to subscribe is called (from any thread), or for
+    # timeout seconds. Every request is served from the one gevent 
+    # thread, which isn't monkey-patched, so rather than waiting on a 
+    # lock - or on one of the handful of threads in gevent's pool, 
+    # which long waits would use up - the wake-up is passed to the hub
+    # through an async watcher. unsubscribe, if given, is handed the 
+    # wake-up function once done with it. 
+    def wait_for_wakeup(subscribe, unsubscribe = None, timeout = None):
+      woken = AsyncResult()
+      watcher = gevent.get_hub().loop.async_()
+      watcher.start(woken.set)
+      wake = watcher.send
+      try:
+        subscribe(wake)
+        woken.wait(timeout)
+      finally:
+        if unsubscribe is not None:
+          unsubscribe(wake)
+        watcher.close()
+
+    # Run function(*arguments) on the control queue, waiting for it 
+    # without holding up the server. Returns its result and an error 
+    # response (or None) if the queue is full or a newer start 
+    # superseded it. 
+    def run_control(function, *arguments):
+      command = control_queue.submit(functools.partial(function, *arguments))
+      if command is None:
+        return None, ({"error": "Too many control requests."}, http.HTTPStatus.TOO_MANY_REQUESTS)
+      wait_for_wakeup(command.add_done_callback)
+      if command.superseded:
+        return None, ({"error": "Superseded by a newer song."}, http.HTTPStatus.CONFLICT)
+      return command.result, None
+
+    # Returns an error response if tempo_factor or transpose are out of
+    # range, otherwise None. 
+    def check_transform_arguments(args):
+      if not args.tempo_factor > 0:
+        return {"error": "tempo_factor must be greater than 0."}, http.HTTPStatus.BAD_REQUEST
+      if not -127 <= args.transpose <= 127:
+        return {"error": "transpose must be between -127 and 127."}, http.HTTPStatus.BAD_REQUEST
+      return None
+
+    # What the player is doing right now. 
+    def playback_status(player):
+      return {"playing" : player.playing, "paused": player._paused is not None, "song": player.playback_position()}
+
+    # Wait up to timeout seconds for status events after sequence 
+    # without holding up the server (see wait_for_wakeup). 
+    def wait_for_events(player, sequence, timeout):
+      status = player.status
+      # A sequence number from before a restart means "from now on". 
+      sequence = min(sequence, status.last_sequence())
+
+      def subscribe(wake):
+        status.add_listener(wake)
+        if status.last_sequence() > sequence:
+          wake()
+      wait_for_wakeup(subscribe, status.remove_listener, timeout)
+      return status.events_after(sequence, 0)
+
+    # Parse the song arguments shared by startSong and enqueueSong.
+    # Returns the arguments and an error response (or None). 
+    def parse_song_arguments(player):
       """
-      Parses all arguments as Unicode strings. 
+      Parses all arguments as Unicode strings. Either midi_contents
+      (a base64 encoded midi file), song_hash (the sha256 of a
+      midi file that has been sent before) or song_id (a song in the
+      library) must be provided. If the hash is not cached, returns
+      404 so the caller can send the full song instead. 
       """
       parser = reqparse.RequestParser()
       parser.add_argument("song_name", type=str)
       parser.add_argument("midi_contents", type=str)
+      parser.add_argument("song_hash", type=str)
+      parser.add_argument("song_id", type=int)
+      parser.add_argument("persist_song", type=inputs.boolean, default=False)
+      parser.add_argument("tempo_factor", type=float, default=1.0)
+      parser.add_argument("transpose", type=int, default=0)
       args = parser.parse_args()
 
-      if player.playing is True:
-        # Stop the current song. 
-        player.stop_song = True
+      error = check_transform_arguments(args)
+      if error is not None:
+        return args, error
+      if args.midi_contents is None and args.song_id is not None:
+        if player.song_library is None or player.song_library.get_song(args.song_id) is None:
+          return args, ({"error": "No such song.", "song_id": args.song_id}, http.HTTPStatus.NOT_FOUND)
+      elif args.midi_contents is None:
+        if args.song_hash is None:
+          return args, ({"error": "midi_contents, song_hash or song_id is required."}, http.HTTPStatus.BAD_REQUEST)
+        if args.song_hash not in player.song_cache:
+          return args, ({"error": "Song is not cached.", "song_hash": args.song_hash}, http.HTTPStatus.NOT_FOUND)
+      return args, None
 
-      while player.playing is True:
-        time.sleep(1)
+    # Starting new songs (and replacing existing songs)
+    def post_start_song(self, player=player):
+      args, error = parse_song_arguments(player)
+      if error is not None:
+        return error
 
-      try:
-        _ = threading.Thread(target=player.play_midi, args=(None, args.song_name, args.midi_contents), daemon=True).start()
-      except Exception as e:
-        print("WARNING: Error playing! Exception:")
-        print(e)
+      start_song(player, song_name = args.song_name, base_64_string = args.midi_contents, 
+        persist_song = args.persist_song, song_hash = args.song_hash, tempo_factor = args.tempo_factor,
+        transpose = args.transpose, song_id = args.song_id)
 
     endpoint_class = type("startSong", (Resource,), {
       "post": post_start_song,
     })
     api.add_resource(endpoint_class, '/%s' % "startSong")
 
+    # Starting new songs from a raw (application/octet-stream) midi
+    # body, avoiding the base64 overhead of startSong. 
+    def post_start_song_raw(self, player=player):
+      """
+      The body is the .mid file itself, read in chunks up to 
+      max_upload_bytes. song_name and persist_song are taken from the
+      query string. 
+      """
+      parser = reqparse.RequestParser()
+      parser.add_argument("song_name", type=str, location="args")
+      parser.add_argument("persist_song", type=inputs.boolean, default=False, location="args")
+      parser.add_argument("tempo_factor", type=float, default=1.0, location="args")
+      parser.add_argument("transpose", type=int, default=0, location="args")
+      args = parser.parse_args()
+
+      error = check_transform_arguments(args)
+      if error is not None:
+        return error
+
+      if request.content_length is not None and request.content_length > max_upload_bytes:
+        return {"error": "Song exceeds %d bytes." % max_upload_bytes}, http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+      midi_bytes = bytearray()
+      while True:
+        chunk = request.stream.read(_upload_chunk_size)
+        if not chunk:
+          break
+        midi_bytes += chunk
+        if len(midi_bytes) > max_upload_bytes:
+          return {"error": "Song exceeds %d bytes." % max_upload_bytes}, http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+      if len(midi_bytes) == 0:
+        return {"error": "Request body is empty."}, http.HTTPStatus.BAD_REQUEST
+
+      start_song(player, song_name = args.song_name, midi_bytes = midi_bytes, 
+        persist_song = args.persist_song, tempo_factor = args.tempo_factor, transpose = args.transpose)
+      return {"song_hash": hash_midi_bytes(midi_bytes)}, http.HTTPStatus.OK
+
+    endpoint_class = type("startSongRaw", (Resource,), {
+      "post": post_start_song_raw,
+    })
+    api.add_resource(endpoint_class, '/%s' % "startSongRaw")
+
     # Stopping playing songs.
     def get_stop_song(self, player=player):
-      if player.playing is True:
-        # Stop the current song. 
-        player.stop_song = True
+      # Stop the current song. 
+      _, error = run_control(player.stop_playing)
+      if error is not None:
+        return error
     
     endpoint_class = type("stopSong", (Resource,), {
       "get": get_stop_song,
     })
     api.add_resource(endpoint_class, '/%s' % "stopSong")
 
+    # Adding songs to the queue. If nothing is playing, the queue
+    # starts playing right away. 
+    def post_enqueue_song(self, player=player):
+      args, error = parse_song_arguments(player)
+      if error is not None:
+        return error
+
+      queued_song = player.enqueue_song(song_name = args.song_name, base_64_string = args.midi_contents,
+        persist_song = args.persist_song, song_hash = args.song_hash, tempo_factor = args.tempo_factor,
+        transpose = args.transpose, song_id = args.song_id)
+      if queued_song is None:
+        return {"error": "Queue is full."}, http.HTTPStatus.TOO_MANY_REQUESTS
+      return {"id": queued_song.song_id, "position": len(player.song_queue)}, http.HTTPStatus.OK
+
+    endpoint_class = type("enqueueSong", (Resource,), {
+      "post": post_enqueue_song,
+    })
+    api.add_resource(endpoint_class, '/%s' % "enqueueSong")
+
+    # Skipping to the next song in the queue.
+    def get_skip_song(self, player=player):
+      player.skip_song()
+
+    endpoint_class = type("skipSong", (Resource,), {
+      "get": get_skip_song,
+    })
+    api.add_resource(endpoint_class, '/%s' % "skipSong")
+
+    # Emptying the queue (the current song keeps playing). 
+    def get_clear_queue(self, player=player):
+      player.song_queue.clear()
+
+    endpoint_class = type("clearQueue", (Resource,), {
+      "get": get_clear_queue,
+    })
+    api.add_resource(endpoint_class, '/%s' % "clearQueue")
+
+    # Listing the queue. 
+    def get_queue(self, player=player):
+      return {"queue": player.song_queue.list()}, http.HTTPStatus.OK
+
+    endpoint_class = type("queue", (Resource,), {
+      "get": get_queue,
+    })
+    api.add_resource(endpoint_class, '/%s' % "queue")
+
+    # Pausing the current song. 
+    def get_pause(self, player=player):
+      paused, error = run_control(player.pause)
+      if error is not None:
+        return error
+      if not paused:
+        return {"error": "Nothing is playing."}, http.HTTPStatus.CONFLICT
+      return player.playback_position(), http.HTTPStatus.OK
+
+    endpoint_class = type("pause", (Resource,), {
+      "get": get_pause,
+    })
+    api.add_resource(endpoint_class, '/%s' % "pause")
+
+    # Resuming the paused song from where it left off. 
+    def get_resume(self, player=player):
+      resumed, error = run_control(player.resume)
+      if error is not None:
+        return error
+      if not resumed:
+        return {"error": "Nothing is paused."}, http.HTTPStatus.CONFLICT
+
+    endpoint_class = type("resume", (Resource,), {
+      "get": get_resume,
+    })
+    api.add_resource(endpoint_class, '/%s' % "resume")
+
+    # Jumping to t seconds into the current (playing or paused) song.
+    def get_seek(self, player=player):
+      parser = reqparse.RequestParser()
+      parser.add_argument("t", type=float, required=True, location="args")
+      args = parser.parse_args()
+
+      sought, error = run_control(player.seek, args.t)
+      if error is not None:
+        return error
+      if not sought:
+        return {"error": "Nothing is playing."}, http.HTTPStatus.CONFLICT
+
+    endpoint_class = type("seek", (Resource,), {
+      "get": get_seek,
+    })
+    api.add_resource(endpoint_class, '/%s' % "seek")
+
+    # Changing the tempo of the current song as it plays. 
+    def get_set_tempo(self, player=player):
+      parser = reqparse.RequestParser()
+      parser.add_argument("tempo_factor", type=float, required=True, location="args")
+      args = parser.parse_args()
+
+      if not args.tempo_factor > 0:
+        return {"error": "tempo_factor must be greater than 0."}, http.HTTPStatus.BAD_REQUEST
+      retimed, error = run_control(player.set_tempo, args.tempo_factor)
+      if error is not None:
+        return error
+      if not retimed:
+        return {"error": "Nothing is playing."}, http.HTTPStatus.CONFLICT
+
+    endpoint_class = type("setTempo", (Resource,), {
+      "get": get_set_tempo,
+    })
+    api.add_resource(endpoint_class, '/%s' % "setTempo")
+
+    # Listing the song library, a page at a time. 
+    def get_songs(self, player=player):
+      """
+      Songs are ordered by id. Pass the returned next value as after
+      to get the following page; it is null on the last page. 
+      """
+      parser = reqparse.RequestParser()
+      parser.add_argument("after", type=int, default=0, location="args")
+      parser.add_argument("limit", type=int, default=50, location="args")
+      args = parser.parse_args()
+
+      if player.song_library is None:
+        return {"error": "No song library."}, http.HTTPStatus.NOT_FOUND
+      songs, next_after = player.song_library.list_songs(after = args.after, limit = args.limit)
+      return {"songs": songs, "next": next_after, "total": len(player.song_library),
+        "refreshing": player.song_library.refreshing}, http.HTTPStatus.OK
+
+    endpoint_class = type("songs", (Resource,), {
+      "get": get_songs,
+    })
+    api.add_resource(endpoint_class, '/%s' % "songs")
+
+    # Re-indexing the song library in the background. 
+    def get_refresh_songs(self, player=player):
+      if player.song_library is None:
+        return {"error": "No song library."}, http.HTTPStatus.NOT_FOUND
+      player.song_library.refresh_in_background()
+      return {"refreshing": True}, http.HTTPStatus.ACCEPTED
+
+    endpoint_class = type("refreshSongs", (Resource,), {
+      "get": get_refresh_songs,
+    })
+    api.add_resource(endpoint_class, '/%s' % "refreshSongs")
+
+    # Timing accuracy of playback, in the Prometheus text format. 
+    def get_metrics(self, player=player):
+      return Response(player.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    endpoint_class = type("metrics", (Resource,), {
+      "get": get_metrics,
+    })
+    api.add_resource(endpoint_class, '/%s' % "metrics")
+
+    # Streaming state changes as Server-Sent Events.
+    def get_events(self, player=player):
+      """
+      Starts with a status event holding the current state, then sends
+      every state change (started, finished, stopped, paused, error,
+      compiled...) as it happens. The data of each event is a JSON 
+      object with the song_name and its elapsed and total seconds 
+      (total is null until a streamed song has been compiled, when a
+      compiled event gives it). While a song is 
+      playing, position events are sent rate times a second (0 for 
+      none). A reconnecting client picks up after Last-Event-ID (or 
+      the after argument). 
+      """
+      parser = reqparse.RequestParser()
+      parser.add_argument("rate", type=float, default=1.0, location="args")
+      parser.add_argument("after", type=int, location="args")
+      args = parser.parse_args()
+
+      sequence = args.after
+      if sequence is None:
+        last_event_id = request.headers.get("Last-Event-ID")
+        sequence = int(last_event_id) if last_event_id is not None and last_event_id.isdigit() else player.status.last_sequence()
+      interval = 1.0 / args.rate if args.rate > 0 else None
+
+      def stream(sequence):
+        yield "event: status\ndata: %s\n\n" % json.dumps(playback_status(player))
+        next_tick = time.monotonic() + (interval or 0)
+        while True:
+          timeout = _event_keepalive if interval is None else max(0.0, next_tick - time.monotonic())
+          events = wait_for_events(player, sequence, timeout)
+          for entry in events:
+            sequence = entry["sequence"]
+            yield "id: %d\nevent: %s\ndata: %s\n\n" % (sequence, entry["event"], json.dumps(entry))
+          if interval is not None and time.monotonic() >= next_tick:
+            next_tick = max(next_tick + interval, time.monotonic())
+            position = player.playback_position()
+            if position is not None and player.playing:
+              yield "event: position\ndata: %s\n\n" % json.dumps({"event": "position", "song_name": position["song_name"],
+                "elapsed": position["position"], "total": position["duration"]})
+          elif len(events) == 0:
+            yield ": keepalive\n\n"
+
+      return Response(stream(sequence), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    endpoint_class = type("events", (Resource,), {
+      "get": get_events,
+    })
+    api.add_resource(endpoint_class, '/%s' % "events")
+
+    # Long-polling for state changes, for clients that can't use 
+    # /events. 
+    def get_status_poll(self, player=player):
+      """
+      Returns the state changes after sequence number after, waiting up
+      to timeout seconds for one if there are none yet, along with the
+      current status. Pass the returned sequence as after next time.
+      Without after, returns right away. 
+      """
+      parser = reqparse.RequestParser()
+      parser.add_argument("after", type=int, location="args")
+      parser.add_argument("timeout", type=float, default=25.0, location="args")
+      args = parser.parse_args()
+
+      events = []
+      sequence = player.status.last_sequence()
+      if args.after is not None:
+        events = wait_for_events(player, args.after, min(max(args.timeout, 0.0), _max_poll_timeout))
+        sequence = events[-1]["sequence"] if len(events) > 0 else min(args.after, sequence)
+      return {"sequence": sequence, "events": events, "status": playback_status(player)}, http.HTTPStatus.OK
+
+    endpoint_class = type("statusPoll", (Resource,), {
+      "get": get_status_poll,
+    })
+    api.add_resource(endpoint_class, '/%s' % "statusPoll")
+
     # Return current status.
     def get_status(self, player=player):
-      return {"playing" : player.playing}, http.HTTPStatus.OK
+      status = playback_status(player)
+      status["ports"] = [output.name for output in player.outputs]
+      status["cache"] = player.song_cache.stats()
+      return status, http.HTTPStatus.OK
     endpoint_class = type("status", (Resource,), {
       "get": get_status,
     })
     api.add_resource(endpoint_class, '/%s' % "status")
 
+    # Whether the output ports are open yet. 
+    def get_ready(self, player=player):
+      """
+      200 once the output ports are open and songs can be played, 503
+      until then, if no port could be opened or while a port is 
+      disconnected. 
+      """
+      ready = player.ready()
+      return ({"ready": ready, "opening": player.opening_ports, "ports": [output.name for output in player.outputs],
+        "disconnected": [output.name for output in player.outputs if not output.connected]},
+        http.HTTPStatus.OK if ready else http.HTTPStatus.SERVICE_UNAVAILABLE)
+    endpoint_class = type("ready", (Resource,), {
+      "get": get_ready,
+    })
+    api.add_resource(endpoint_class, '/%s' % "ready")
+
+    # Turning profiling on and off. 
+    def get_profile(self, player=player):
+      """
+      With enabled=true, writes a profile of every song played from
+      then on (see profiler.py); enabled=false stops. Returns whether
+      profiling is on and the profiles written most recently. 
+      """
+      parser = reqparse.RequestParser()
+      parser.add_argument("enabled", type=inputs.boolean, location="args")
+      args = parser.parse_args()
+
+      if profiler is None:
+        return {"error": "Profiling is not available."}, http.HTTPStatus.NOT_FOUND
+      if args.enabled is True:
+        profiler.enable()
+      elif args.enabled is False:
+        profiler.disable()
+      return {"enabled": profiler.enabled, "directory": profiler.directory, "profiles": profiler.profiles}, http.HTTPStatus.OK
+    endpoint_class = type("profile", (Resource,), {
+      "get": get_profile,
+    })
+    api.add_resource(endpoint_class, '/%s' % "profile")
+
+    if profiler is not None:
+      profiler.add_handlers(app)
+
     print("[INFO] Server is now online at http://%s:%d." % ("localhost", application_port))
     app.debug = True 
-    http_server = WSGIServer(("localhost", application_port), app)
+    # listener is an already bound control socket, if any (see 
+    # bind_control_socket). gevent accepts from it without waiting, so
+    # it has to be non-blocking. 
+    if listener is not None:
+      listener.setblocking(False)
+    http_server = WSGIServer(listener if listener is not None else ("localhost", application_port), app)
     http_server.serve_forever() 
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
   parser.add_argument("application_port")
+  parser.add_argument("--cache_max_entries", type=int, default=16)
+  parser.add_argument("--cache_max_bytes", type=int, default=64 * 1024 * 1024)
+  parser.add_argument("--max_upload_bytes", type=int, default=32 * 1024 * 1024)
+  parser.add_argument("--max_queue_length", type=int, default=32)
+  parser.add_argument("--max_pending_controls", type=int, default=16, help="Control requests (start, stop, pause...) that may wait to be run before more are refused with 429.")
+  parser.add_argument("--sender_buffer_size", type=int, default=256, help="Groups of events the real-time sender may hold.")
+  parser.add_argument("--output_ports", help="Comma separated names of the output ports to play to. Defaults to the default port.")
+  parser.add_argument("--channel_routing", help="Which channels (0-15) to play on which port, i.e. 'Piano=0-8;Synth=9-15'. Defaults to all channels on every port.")
+  parser.add_argument("--raw_midi_device", help="Raw MIDI device node (i.e. /dev/snd/midiC1D0) to write batched events to directly.")
+  parser.add_argument("--library_index", help="Location of the song library index. Defaults to library.sqlite3 in piano_songs_location.")
+  parser.add_argument("--compact", action="store_true", help="Drop redundant events (repeated controller values, stray note offs) from songs before playing them.")
+  parser.add_argument("--compact_tolerance", type=int, default=0, help="With --compact, how far (0-127) a controller may drift before it is sent again.")
+  parser.add_argument("--profile", action="store_true", help="Write a profile of every song played (see profiler.py). Also turned on by setting " + profile_environment_variable + " to the directory to write them to, or with /profile.")
+  parser.add_argument("--profile_dir", default="./subprocesses/usb_piano_player/profiles", help="Where profiles are written when turned on with --profile or /profile.")
   args = parser.parse_args()
   application_port = args.application_port
+  listener = bind_control_socket(application_port)
+  # Songs are parsed in worker processes, away from playback. 
+  compile_pool = CompilePool()
+  compile_pool_starter = threading.Timer(_compile_pool_start_delay, compile_pool.start)
+  compile_pool_starter.daemon = True
+  compile_pool_starter.start()
 
-  player = UsbPianoPlayer()
-  PianoPlayerWebServer(application_port, player)
+  song_library = None
+  try:
+    song_library = SongLibrary(UsbPianoPlayer.piano_songs_location, index_location = args.library_index,
+      compile_pool = compile_pool)
+    song_library.refresh_in_background()
+  except Exception as e:
+    print("[WARNING] UsbPianoPlayer was unable to open the song library. Exception: ")
+    print(e)
+
+  player = UsbPianoPlayer(cache_max_entries = args.cache_max_entries, cache_max_bytes = args.cache_max_bytes,
+    max_queue_length = args.max_queue_length, raw_midi_device = args.raw_midi_device,
+    sender_buffer_size = args.sender_buffer_size, song_library = song_library,
+    output_port_names = args.output_ports.split(",") if args.output_ports else None,
+    channel_routing = parse_channel_routing(args.channel_routing) if args.channel_routing else None,
+    open_ports_in_background = True, compile_pool = compile_pool, compact = args.compact,
+    compact_tolerance = args.compact_tolerance)
+  # Reconnect to the piano when it is turned off and on again. 
+  PortWatcher(player).start()
+  profiler = Profiler(os.environ.get(profile_environment_variable) or args.profile_dir, player = player)
+  if args.profile or os.environ.get(profile_environment_variable):
+    profiler.enable()
+  PianoPlayerWebServer(application_port, player, max_upload_bytes = args.max_upload_bytes, listener = listener,
+    max_pending_controls = args.max_pending_controls, profiler = profiler)
 
   """
   else: